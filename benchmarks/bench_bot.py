@@ -0,0 +1,157 @@
+"""Benchmark of the poll -> parse -> notify hot path of the bot.
+
+Drives get_api_answer -> check_response -> parse_status -> send_message
+against local stand-ins of Practicum and Telegram, reports throughput,
+latency histograms per stage and memory, and saves them to JSON:
+
+    python benchmarks/bench_bot.py --homeworks 50 --output new.json
+    python benchmarks/bench_bot.py --compare old.json --output new.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import homework  # noqa: E402
+from benchmarks import standins  # noqa: E402
+
+BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+STAGES = (
+    'get_api_answer', 'check_response', 'parse_status', 'send_message',
+    'total',
+)
+
+
+def run_pipeline(bot, timings):
+    """One cycle of the bot, durations of the stages go to timings."""
+    started = time.perf_counter()
+    response = homework.get_api_answer(0)
+    answered = time.perf_counter()
+    homeworks = homework.check_response(response)
+    checked = time.perf_counter()
+    messages = [homework.parse_status(item) for item in homeworks]
+    parsed = time.perf_counter()
+    homework.send_message(bot, messages[0])
+    sent = time.perf_counter()
+    points = (started, answered, checked, parsed, sent)
+    for stage, begin, end in zip(STAGES, points, points[1:]):
+        timings[stage].append((end - begin) * 1000)
+    timings['total'].append((sent - started) * 1000)
+
+
+def histogram(values):
+    """Percentiles and counts per bucket of latencies in milliseconds."""
+    quantiles = statistics.quantiles(values, n=100)
+    counts = {f'le_{bound}': 0 for bound in BUCKETS_MS}
+    counts['le_inf'] = 0
+    for value in values:
+        bound = next((b for b in BUCKETS_MS if value <= b), 'inf')
+        counts[f'le_{bound}'] += 1
+    return {
+        'p50_ms': round(quantiles[49], 4),
+        'p90_ms': round(quantiles[89], 4),
+        'p99_ms': round(quantiles[98], 4),
+        'max_ms': round(max(values), 4),
+        'buckets': counts,
+    }
+
+
+def measure_memory(bot, iterations):
+    """Peak of memory allocated by the pipeline, in KiB."""
+    timings = {stage: [] for stage in STAGES}
+    tracemalloc.start()
+    for _ in range(iterations):
+        run_pipeline(bot, timings)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+def commit():
+    """Current commit of the repository, if it is one."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    """Print p50 of every stage against a saved run."""
+    with open(path, encoding='utf-8') as file:
+        old = json.load(file)
+    for stage in STAGES:
+        before = old['stages'][stage]['p50_ms']
+        after = results['stages'][stage]['p50_ms']
+        change = (after - before) / before * 100 if before else 0
+        print(f'{stage:>15}: {before:.4f} -> {after:.4f} ms ({change:+.1f}%)')
+
+
+def parse_args():
+    """Options of the benchmark."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--homeworks', type=int, default=20)
+    parser.add_argument('--comment-size', type=int, default=200)
+    parser.add_argument('--api-latency', type=float, default=0,
+                        help='seconds before Practicum stand-in answers')
+    parser.add_argument('--telegram-latency', type=float, default=0,
+                        help='seconds before Telegram stand-in answers')
+    parser.add_argument('--session', action='store_true',
+                        help='poll through the pooled keep-alive session')
+    parser.add_argument('--output', help='save results to this JSON file')
+    parser.add_argument('--compare', help='JSON file of a previous run')
+    return parser.parse_args()
+
+
+def main():
+    """Run the benchmark and report results."""
+    args = parse_args()
+    practicum = standins.start_practicum(
+        args.api_latency, args.homeworks, args.comment_size
+    )
+    telegram = standins.start_telegram(args.telegram_latency)
+    homework.ENDPOINT = practicum.url
+    if args.session:
+        homework.http_session.set(homework.create_session())
+    from telebot import TeleBot
+
+    bot = TeleBot('1:bench', threaded=False)
+    timings = {stage: [] for stage in STAGES}
+    started = time.perf_counter()
+    for _ in range(args.iterations):
+        run_pipeline(bot, timings)
+    elapsed = time.perf_counter() - started
+    results = {
+        'commit': commit(),
+        'config': vars(args),
+        'throughput_per_s': round(args.iterations / elapsed, 1),
+        'stages': {stage: histogram(timings[stage]) for stage in STAGES},
+        'memory_peak_kib': measure_memory(
+            bot, max(args.iterations // 10, 1)
+        ),
+        'payload_bytes': len(practicum.payload),
+    }
+    practicum.shutdown()
+    telegram.shutdown()
+    if args.compare:
+        compare(results, args.compare)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(results, file, indent=2)
+    print(json.dumps(
+        {key: value for key, value in results.items() if key != 'stages'},
+        indent=2
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Latency of get_api_answer with and without a keep-alive session.
+
+Runs a local stand-in of ENDPOINT and prints p50/p99 per poll:
+
+    python benchmarks/bench_session.py --polls 2000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import homework  # noqa: E402
+from benchmarks import standins  # noqa: E402
+
+
+def measure(polls):
+    """Poll the stand-in and return latency percentiles."""
+    latencies = []
+    for _ in range(polls):
+        started = time.perf_counter()
+        homework.get_api_answer(0)
+        latencies.append((time.perf_counter() - started) * 1000)
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {'p50_ms': round(quantiles[49], 3), 'p99_ms': round(quantiles[98], 3)}
+
+
+def main():
+    """Compare requests.get with the pooled session."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--polls', type=int, default=1000)
+    args = parser.parse_args()
+    server = standins.start_practicum()
+    homework.ENDPOINT = server.url
+    results = {'requests.get': measure(args.polls)}
+    homework.http_session.set(homework.create_session())
+    results['session'] = measure(args.polls)
+    server.shutdown()
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
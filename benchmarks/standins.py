@@ -0,0 +1,119 @@
+"""Local stand-ins of the Practicum API and the Telegram Bot API."""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+STATUSES = ('approved', 'reviewing', 'rejected')
+
+
+def homework_statuses(homeworks=1, comment_size=0, current_date=0):
+    """Answer of homework_statuses with the given number of homeworks."""
+    return json.dumps({
+        'homeworks': [
+            {
+                'id': index,
+                'status': STATUSES[index % len(STATUSES)],
+                'homework_name': f'student__hw{index:05}.zip',
+                'reviewer_comment': 'x' * comment_size,
+                'date_updated': '2021-04-11T10:31:09Z',
+                'lesson_name': 'Проект спринта',
+            }
+            for index in range(homeworks)
+        ],
+        'current_date': current_date,
+    }).encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Keep-alive handler answering after the latency of the server."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def reply(self, body, status=200, headers=()):
+        """Send JSON body after the configured latency."""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        self.server.requests += 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """Keep benchmark output clean."""
+
+
+class PracticumHandler(StandInHandler):
+    """GET homework_statuses.
+    server.status other than 200 is sent without payload, with
+    server.etag set a matching If-None-Match gets 304.
+    """
+
+    def do_GET(self):
+        """Send the prepared payload."""
+        etag = self.server.etag
+        if etag and self.headers.get('If-None-Match') == etag:
+            self.reply(b'', 304)
+        elif self.server.status != 200:
+            self.reply(b'{}', self.server.status)
+        else:
+            self.reply(
+                self.server.payload, headers=[('ETag', etag)] if etag else ()
+            )
+
+
+class TelegramHandler(StandInHandler):
+    """GET or POST bot<token>/<method>, calls are kept in server.calls."""
+
+    def do_POST(self):
+        """Accept message and echo it back as Telegram does."""
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        url = urlsplit(self.path)
+        self.server.calls.append(
+            (url.path.rsplit('/', 1)[-1], dict(parse_qsl(url.query)))
+        )
+        self.reply(json.dumps({'ok': True, 'result': {
+            'message_id': self.server.requests,
+            'date': int(time.time()),
+            'chat': {'id': 1, 'type': 'private'},
+            'text': body.decode(errors='replace')[:64],
+        }}).encode())
+
+    do_GET = do_POST
+
+
+def start(handler, latency=0, payload=b''):
+    """Serve the handler on a free local port in a daemon thread."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.payload = payload
+    server.requests = 0
+    server.status = 200
+    server.etag = None
+    server.calls = []
+    server.url = f'http://127.0.0.1:{server.server_port}/'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_practicum(latency=0, homeworks=1, comment_size=0):
+    """Stand-in of ENDPOINT."""
+    return start(
+        PracticumHandler, latency, homework_statuses(homeworks, comment_size)
+    )
+
+
+def start_telegram(latency=0):
+    """Stand-in of api.telegram.org, point telebot to it."""
+    from telebot import apihelper
+
+    server = start(TelegramHandler, latency)
+    apihelper.API_URL = server.url + 'bot{0}/{1}'
+    return server
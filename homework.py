@@ -1,37 +1,83 @@
+import atexit
+import bisect
+import functools
+import hashlib
+import heapq
+import inspect
+import json
 import logging
+import mmap
+import multiprocessing
 import os
+import queue
+import random
+import re
+import signal
+import sqlite3
+import string
+import struct
+import sys
+import threading
 import time
+from collections import Counter, deque, namedtuple
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from enum import Enum
 from http import HTTPStatus
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from types import MappingProxyType
+from urllib.parse import urlsplit
 
-import requests
-from dotenv import load_dotenv
-from telebot import TeleBot
+if __name__ == '__main__':
+    from dotenv import load_dotenv
 
+    load_dotenv()
 
-load_dotenv()
-logging.basicConfig(
-    level=logging.DEBUG,
-    filename='main.log',
-    format='%(asctime)s, %(levelname)s, %(message)s, %(name)s',
-    filemode='w',
-)
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-handler = RotatingFileHandler(
-    'my_logger.log',
-    maxBytes=50000000,
-    backupCount=5
-)
-logger.addHandler(handler)
-formatter = logging.Formatter(
-    '%(asctime)s, %(levelname)s, %(message)s, %(name)s'
-)
-handler.setFormatter(formatter)
 
 PRACTICUM_TOKEN = os.getenv('PRACTICUM_TOKEN')
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
+TENANTS_FILE = os.getenv('TENANTS_FILE')
+ASYNC_MODE = bool(os.getenv('ASYNC_MODE'))
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', 100))
+SHARDS = int(os.getenv('SHARDS', 1))
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 10))
+REVIEWING_PERIOD = int(os.getenv('REVIEWING_PERIOD', 120))
+MAX_RETRY_PERIOD = int(os.getenv('MAX_RETRY_PERIOD', 3600))
+IDLE_POLLS = int(os.getenv('IDLE_POLLS', 36))
+REQUEST_BUDGET = float(os.getenv('REQUEST_BUDGET', 0))
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite')
+STATE_DB = os.getenv('STATE_DB')
+EVENT_LOG = os.getenv('EVENT_LOG')
+EVENT_LOG_COMPACT = int(os.getenv('EVENT_LOG_COMPACT', 1 << 20))
+TELEGRAM_RATE = float(os.getenv('TELEGRAM_RATE', 30))
+CHAT_RATE = float(os.getenv('CHAT_RATE', 1))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', 4))
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', 5))
+BREAKER_COOLDOWN = float(os.getenv('BREAKER_COOLDOWN', 60))
+ERROR_WINDOW = int(os.getenv('ERROR_WINDOW', 3600))
+STALL_PERIODS = float(os.getenv('STALL_PERIODS', 3))
+CONNECT_TIMEOUT = float(os.getenv('CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.getenv('READ_TIMEOUT', 10))
+RETRIES = int(os.getenv('RETRIES', 2))
+RETRY_BACKOFF = float(os.getenv('RETRY_BACKOFF', 0.5))
+RETRY_RATIO = float(os.getenv('RETRY_RATIO', 0.1))
+RETRY_RESERVE = float(os.getenv('RETRY_RESERVE', 10))
+HEDGE_REQUESTS = bool(os.getenv('HEDGE_REQUESTS'))
+COMMANDS_MODE = os.getenv('COMMANDS_MODE')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+HISTORY_SIZE = int(os.getenv('HISTORY_SIZE', 10))
+LOCALE = os.getenv('LOCALE', 'ru')
+MESSAGES_FILE = os.getenv('MESSAGES_FILE')
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', 4096))
+SERVICE_HOST = os.getenv('SERVICE_HOST', '127.0.0.1')
+SERVICE_PORT = os.getenv('SERVICE_PORT')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG').upper()
+LOG_FILE = os.getenv('LOG_FILE', 'main.log')
 
 RETRY_PERIOD = 600
 ENDPOINT = 'https://practicum.yandex.ru/api/user_api/homework_statuses/'
@@ -42,49 +88,1904 @@ HOMEWORK_VERDICTS = {
     'reviewing': 'Работа взята на проверку ревьюером.',
     'rejected': 'Работа проверена: у ревьюера есть замечания.'
 }
+MESSAGES = {
+    'ru': {
+        'message': 'Изменился статус проверки работы "{name}". {verdict}',
+        'verdicts': HOMEWORK_VERDICTS,
+    },
+    'en': {
+        'message': 'Review status of "{name}" changed. {verdict}',
+        'verdicts': {
+            'approved': 'Reviewed: the reviewer liked everything. Hooray!',
+            'reviewing': 'The reviewer has taken the work for review.',
+            'rejected': 'Reviewed: the reviewer has remarks.',
+        },
+    },
+}
 
 FIRST_TIMESTAMP = 0
+MESSAGE_LIMIT = 4096
+BODY_LIMIT = 1 << 20
+HEDGE_QUANTILE = 0.95
+HEDGE_SAMPLES = 20
+LATENCY_WINDOW = 200
+INDEX_BUCKETS = 1 << 16
+CURRENT_DATE_PATTERN = re.compile(rb'"current_date"\s*:\s*\d+')
+UNCHANGED = MappingProxyType({'homeworks': []})
+ANSWER_FIELDS = ('homeworks', 'current_date')
+HOMEWORK_FIELDS = (
+    'id', 'homework_name', 'status', 'date_updated', 'reviewer_comment'
+)
+METRICS_PREFIX = 'homework_bot_'
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, extra fields included."""
+
+    STANDARD = frozenset(vars(logging.makeLogRecord({}))) | {'message'}
+
+    def format(self, record):
+        """Format record as JSON."""
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        data.update(
+            (key, value) for key, value in vars(record).items()
+            if key not in self.STANDARD
+        )
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(QueueHandler):
+    """Hands records to the listener thread without formatting them.
+    Traceback is formatted and written by the listener,
+    so logging never adds disk I/O to a poll or a send.
+    """
+
+    def prepare(self, record):
+        """Merge message arguments, keep exc_info for the listener."""
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def setup_logging(level=LOG_LEVEL, filename=LOG_FILE):
+    """Send records of the root logger through a queue to a JSON file."""
+    root = logging.getLogger()
+    if any(isinstance(handler, LogQueueHandler) for handler in root.handlers):
+        return None
+    log_queue = queue.SimpleQueue()
+    file_handler = RotatingFileHandler(
+        filename,
+        maxBytes=50000000,
+        backupCount=5
+    )
+    file_handler.setFormatter(JsonFormatter())
+    listener = QueueListener(log_queue, file_handler)
+    root.addHandler(LogQueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class Metrics:
+    """Counters, gauges and latency histograms in Prometheus format.
+    Update is one dict operation under a lock, so it stays on
+    in production; text is rendered only when it is scraped.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        """Start with no metrics."""
+        self.lock = threading.Lock()
+        self.counters = Counter()
+        self.histograms = {}
+        self.gauges = {}
+
+    def inc(self, name, value=1, **labels):
+        """Increase counter with the labels."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+
+    def get(self, name, **labels):
+        """Value of counter with the labels."""
+        return self.counters[(name, tuple(sorted(labels.items())))]
+
+    def observe(self, name, seconds):
+        """Put duration into the histogram."""
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            histogram = self.histograms[name]
+            histogram[bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        """Measure duration of the block into the histogram."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def timed(self, name):
+        """Decorator measuring duration of the function calls."""
+        def decorator(func):
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def async_wrapper(*args, **kwargs):
+                    with self.timer(name):
+                        return await func(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def gauge(self, name, function):
+        """Report value of the function as a gauge."""
+        self.gauges[name] = function
+
+    def _render_counters(self, counters):
+        """Lines of counters and gauges."""
+        lines, typed = [], set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {METRICS_PREFIX}{name} counter')
+            text = ','.join(f'{key}="{value}"' for key, value in labels)
+            labels = f'{{{text}}}' if text else ''
+            lines.append(f'{METRICS_PREFIX}{name}{labels} {value}')
+        for name, function in sorted(self.gauges.items()):
+            lines.append(f'# TYPE {METRICS_PREFIX}{name} gauge')
+            lines.append(f'{METRICS_PREFIX}{name} {function()}')
+        return lines
+
+    def _render_histograms(self, histograms):
+        """Lines of histograms."""
+        lines = []
+        for name, histogram in histograms:
+            name = METRICS_PREFIX + name
+            lines.append(f'# TYPE {name} histogram')
+            count = 0
+            for bound, bucket in zip(self.BUCKETS + ('+Inf',), histogram):
+                count += bucket
+                lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+            lines.append(f'{name}_sum {histogram[-1]}')
+            lines.append(f'{name}_count {count}')
+        return lines
+
+    def render(self):
+        """All metrics in Prometheus text format."""
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (name, list(histogram))
+                for name, histogram in self.histograms.items()
+            )
+        lines = self._render_counters(counters)
+        lines += self._render_histograms(histograms)
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+current_tenant = ContextVar('current_tenant', default=None)
+http_session = ContextVar('http_session', default=None)
+current_chat = ContextVar('current_chat', default=None)
+Shard = namedtuple('Shard', ('index', 'ring', 'limit'))
+Subscriber = namedtuple('Subscriber', ('chat_id', 'locale'))
+shard = None
+
+
+Status = Enum(
+    'Status', {status.upper(): status for status in HOMEWORK_VERDICTS},
+    type=str
+)
+
+
+class BotError(Exception):
+    """Base of the errors of the bot, upstream is the failing service."""
+
+    upstream = 'bot'
+
+
+class APIError(BotError):
+    """Practicum API failed or answered nonsense."""
+
+    upstream = 'practicum'
+
+
+class APIRequestError(APIError):
+    """Request to Practicum was not answered."""
+
+
+class APIStatusError(APIError):
+    """Practicum answered with unexpected HTTP status."""
+
+    def __init__(self, status):
+        """Keep the status for the handlers."""
+        super().__init__(f'Ошибка в статусе ответа: {status}')
+        self.status = status
+
+
+class ResponseTypeError(APIError, TypeError):
+    """Answer of Practicum has a field of wrong type."""
+
+
+class ResponseDecodeError(APIError, ValueError):
+    """Answer of Practicum is not JSON."""
+
+
+class ResponseKeyError(APIError, KeyError):
+    """Answer of Practicum misses a field."""
+
+
+class HomeworkError(APIError, KeyError):
+    """Homework of the answer can not be parsed."""
+
+
+def error_kind(error):
+    """Class and upstream of the error, errors of a kind are grouped."""
+    return type(error).__name__, getattr(error, 'upstream', BotError.upstream)
+
+
+def _homework_key(homework):
+    """Key of the homework in the index of statuses."""
+    return homework.get('id', homework.get('homework_name'))
+
+
+class Homework(
+    namedtuple('Homework', ('key', 'name', 'status', 'date_updated'))
+):
+    """Validated homework with only the fields the bot uses.
+    Tuple without instance dict, interned name and Status member
+    keep statuses of thousands of tenants small.
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_dict(cls, homework):
+        """Validate homework of the API answer."""
+        if (name := homework.get('homework_name')) is None:
+            logger.debug('Dict don`t have key {homework_name}')
+            raise HomeworkError('В словаре нет ключа homework_name')
+        if (status := homework.get('status')) is None:
+            raise HomeworkError(f'В словаре нет ключа status у работы {name}')
+        if status not in HOMEWORK_VERDICTS:
+            raise HomeworkError(f'Вердикт не определён: {status}')
+        return cls(
+            _homework_key(homework), sys.intern(name), Status(status),
+            homework.get('date_updated')
+        )
+
+
+class MessageCatalog:
+    """Status messages in several languages.
+    Template of every locale and status is compiled once with the
+    verdict in place, ready messages are cached per status, name
+    and locale, so a change sent to many chats is formatted once.
+    Unknown locales fall back to the default one.
+    """
+
+    def __init__(self, entries, default=LOCALE, cache_size=MESSAGE_CACHE_SIZE):
+        """Compile templates of the entries."""
+        self.default = default
+        self.entries = {}
+        self.templates = {}
+        self.format = functools.lru_cache(cache_size)(self._format)
+        self.update(entries)
+
+    def update(self, entries):
+        """Add or override locales, verdicts are merged with known ones."""
+        for locale, entry in entries.items():
+            known = self.entries.get(locale) or self.entries.get(
+                self.default, {'verdicts': {}}
+            )
+            entry = {
+                **known, **entry,
+                'verdicts': {**known['verdicts'], **entry.get('verdicts', {})}
+            }
+            for status, verdict in entry['verdicts'].items():
+                self.templates[locale, status] = self._compile(
+                    entry['message'], verdict
+                )
+            self.entries[locale] = entry
+        self.format.cache_clear()
+
+    def load(self, path):
+        """Update catalog from JSON file of locale entries."""
+        with open(path, encoding='utf-8') as file:
+            self.update(json.load(file))
+
+    @staticmethod
+    def _compile(template, verdict):
+        """Format method of the template with only the name left in it."""
+        parts = []
+        for literal, field, _, _ in string.Formatter().parse(template):
+            parts.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field == 'verdict':
+                parts.append(verdict.replace('{', '{{').replace('}', '}}'))
+            elif field == 'name':
+                parts.append('{name}')
+            elif field is not None:
+                raise ValueError(
+                    f'Неизвестное поле {field} в шаблоне {template!r}'
+                )
+        return ''.join(parts).format
+
+    def _format(self, status, name, locale):
+        """Message about the status of the homework."""
+        template = self.templates.get((locale, status))
+        if template is None:
+            template = self.templates[self.default, status]
+        return template(name=name)
+
+    def check(self):
+        """Raise ValueError unless the default locale has every verdict."""
+        verdicts = self.entries.get(self.default, {'verdicts': {}})['verdicts']
+        if missing := set(HOMEWORK_VERDICTS) - set(verdicts):
+            raise ValueError(
+                f'Для языка {self.default} нет вердиктов: '
+                f'{", ".join(sorted(missing))}'
+            )
+
+    def verdict(self, status, locale):
+        """Verdict of the status in the locale."""
+        entry = self.entries.get(locale) or self.entries[self.default]
+        return entry['verdicts'].get(
+            status, self.entries[self.default]['verdicts'][status]
+        )
+
+
+catalog = MessageCatalog(MESSAGES)
+
+
+def load_messages():
+    """Load MESSAGES_FILE into the catalog, check the default locale."""
+    if MESSAGES_FILE:
+        catalog.load(MESSAGES_FILE)
+    try:
+        catalog.check()
+    except ValueError as error:
+        logger.critical(f'Messages of locale {catalog.default} are missing')
+        raise Exception(error)
+
+
+class ErrorWindow:
+    """Errors of a tenant grouped by kind, see error_kind.
+    The first error of a kind is reported at once, repeats are only
+    counted and reported as one digest per window. Kind without
+    repeats for a whole window is forgotten. Windows go by wall
+    clock, so they are saved with the state and survive restart.
+    """
+
+    __slots__ = ('window', 'kinds')
+
+    def __init__(self, window=ERROR_WINDOW):
+        """Start without errors."""
+        self.window = window
+        self.kinds = {}
+
+    def add(self, error, now=None):
+        """Count the error, return True if it is the first of its kind."""
+        now = time.time() if now is None else now
+        if (counter := self.kinds.get(error_kind(error))) is not None:
+            counter[1] += 1
+            return False
+        self.kinds[error_kind(error)] = [now, 0]
+        return True
+
+    def flush(self, now=None):
+        """Return digests of the kinds whose window is over."""
+        now = time.time() if now is None else now
+        digests = []
+        for kind, (started, repeats) in list(self.kinds.items()):
+            if now - started < self.window:
+                continue
+            if not repeats:
+                del self.kinds[kind]
+                continue
+            self.kinds[kind] = [now, 0]
+            digests.append(
+                'Сбой {} ({}) повторился {} раз за {} мин.'.format(
+                    *kind, repeats, round((now - started) / 60)
+                )
+            )
+        return digests
+
+    def dump(self):
+        """Kinds with their windows as JSON."""
+        return json.dumps([
+            [*kind, started, repeats]
+            for kind, (started, repeats) in self.kinds.items()
+        ])
+
+    def load(self, text):
+        """Restore kinds dumped by dump."""
+        self.kinds = {
+            (name, upstream): [started, repeats]
+            for name, upstream, started, repeats in json.loads(text or '[]')
+        }
+
+
+class Tenant:
+    """Practicum token subscribed to one or more Telegram chats.
+    Slots keep the per-tenant state at about 1.5 KB before homeworks,
+    so one process can hold thousands of subscriptions.
+    The first subscriber is the main chat of the tenant.
+    """
+
+    __slots__ = (
+        'token', 'chat_id', 'timestamp',
+        'etag', 'last_modified', 'digest', 'fetched',
+        'errors', 'idle', 'reviewing', 'statuses',
+        'paused', 'history', 'locale', 'subscribers', 'failures'
+    )
+
+    def __init__(self, token, chat_id, timestamp=FIRST_TIMESTAMP,
+                 locale=LOCALE, subscribers=None):
+        """Start tenant from the first timestamp and empty messages."""
+        self.token = token
+        self.subscribers = tuple(subscribers or [Subscriber(chat_id, locale)])
+        self.chat_id, self.locale = self.subscribers[0]
+        self.timestamp = timestamp
+        self.failures = ErrorWindow()
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self.fetched = None
+        self.errors = 0
+        self.idle = 0
+        self.reviewing = False
+        self.statuses = {}
+        self.paused = set()
+        self.history = deque(maxlen=HISTORY_SIZE)
+
+    @property
+    def key(self):
+        """Stable id of the tenant which does not reveal the token."""
+        return hashlib.sha256(self.token.encode()).hexdigest()[:32]
+
+    @property
+    def headers(self):
+        """Authorization and conditional request headers of the tenant."""
+        headers = {'Authorization': f'OAuth {self.token}'}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+    def changes(self, homeworks):
+        """Homeworks with status changed since the last poll, oldest first.
+        Pairs of the record and the dict of the answer. Index lookups
+        keep it O(changed): API gives only homeworks updated after
+        from_date. Invalid homework is logged and skipped, it does
+        not hide transitions of the others.
+        """
+        changes = []
+        for homework in homeworks:
+            known = self.statuses.get(_homework_key(homework))
+            if known is not None and known.status == homework.get('status'):
+                continue
+            try:
+                changes.append((Homework.from_dict(homework), homework))
+            except HomeworkError as error:
+                logger.error(f'Homework is skipped: {error}')
+                metrics.inc(
+                    'errors_total', stage='parse', type=type(error).__name__
+                )
+        changes.sort(key=lambda change: change[0].date_updated or '')
+        return changes
+
+    def diff(self, changes):
+        """Homeworks of the changes to report.
+        First poll reports the latest one only, others are committed.
+        Poll is the first until an answer moves the timestamp, known
+        statuses do not tell it: the first answers may be empty.
+        """
+        changed = [homework for homework, _ in changes]
+        if self.timestamp == FIRST_TIMESTAMP:
+            self.commit(changed[:-1])
+            return changed[-1:]
+        return changed
+
+    def commit(self, homeworks):
+        """Store the reported homeworks in the index of statuses."""
+        for homework in homeworks:
+            self.statuses[homework.key] = homework
+        self.reviewing = any(
+            homework.status is Status.REVIEWING
+            for homework in self.statuses.values()
+        )
+
+    def is_unchanged(self, headers, body):
+        """Keep validators of the answer, tell if it repeats the last.
+        current_date changes on every answer, so it is not hashed.
+        Validators are used only after the answer is handled, see accept.
+        """
+        digest = None
+        if isinstance(body, bytes):
+            digest = hashlib.blake2b(
+                CURRENT_DATE_PATTERN.sub(b'', body), digest_size=16
+            ).digest()
+        self.fetched = (
+            headers.get('ETag'), headers.get('Last-Modified'), digest
+        )
+        return digest is not None and digest == self.digest
+
+    def accept(self):
+        """Answer is handled, next one repeating it is not handled again."""
+        if self.fetched is not None:
+            self.etag, self.last_modified, self.digest = self.fetched
+            self.fetched = None
+
+
+class Scheduler:
+    """Min-heap of tenants ordered by the time of the next poll.
+    Interval of every tenant adapts to its state, and polls of all
+    tenants together fit into the budget of requests per second.
+    """
+
+    def __init__(self, tenants, period=RETRY_PERIOD, now=None,
+                 budget=REQUEST_BUDGET):
+        """Spread first polls of the tenants evenly over the period."""
+        now = time.monotonic() if now is None else now
+        step = period / len(tenants) if tenants else 0
+        self.period = period
+        self.budget = budget
+        self._tokens = max(budget, 1)
+        self._updated = now
+        self._counter = len(tenants)
+        self._queue = [
+            (now + index * step, index, tenant)
+            for index, tenant in enumerate(tenants)
+        ]
+        heapq.heapify(self._queue)
+
+    def __len__(self):
+        """Count scheduled tenants."""
+        return len(self._queue)
+
+    def _refill(self, now):
+        """Add tokens of the request budget earned since last call."""
+        self._tokens = min(
+            self._tokens + (now - self._updated) * self.budget,
+            max(self.budget, 1)
+        )
+        self._updated = now
+
+    def pop_due(self, now):
+        """Take out tenants which should be polled by now."""
+        self._refill(now)
+        due = []
+        while self._queue and self._queue[0][0] <= now:
+            if self.budget:
+                if self._tokens < 1:
+                    break
+                self._tokens -= 1
+            due.append(heapq.heappop(self._queue)[2])
+        return due
+
+    def push(self, tenant, due):
+        """Schedule next poll of the tenant."""
+        self._counter += 1
+        heapq.heappush(self._queue, (due, self._counter, tenant))
+
+    def _backoff(self, attempt):
+        """Exponential interval with jitter, first attempt waits a period."""
+        if attempt <= 1:
+            return self.period
+        ceiling = min(
+            self.period * 2 ** min(attempt - 1, 16), MAX_RETRY_PERIOD
+        )
+        return random.uniform(self.period, max(ceiling, self.period))
+
+    def interval(self, tenant):
+        """Seconds until the next poll of the tenant.
+        Homework on review is polled often, errors and long silence
+        back off exponentially up to MAX_RETRY_PERIOD.
+        """
+        if tenant.errors:
+            return self._backoff(tenant.errors)
+        if tenant.reviewing:
+            return REVIEWING_PERIOD
+        if tenant.idle > IDLE_POLLS:
+            return self._backoff(tenant.idle - IDLE_POLLS)
+        return self.period
+
+    def reschedule(self, tenants, now):
+        """Schedule next polls of the polled tenants."""
+        for tenant in tenants:
+            self.push(tenant, now + self.interval(tenant))
+
+    def delay(self, now):
+        """Seconds left until the nearest poll, to a millisecond."""
+        if not self._queue:
+            return self.period
+        delay = self._queue[0][0] - now
+        if self.budget and self._tokens < 1:
+            delay = max(delay, (1 - self._tokens) / self.budget)
+        return round(max(delay, 0), 3)
+
+
+def _subscribers(chats):
+    """Subscribers from chat id, object with chat_id and locale or list."""
+    if not isinstance(chats, list):
+        chats = [chats]
+    return [
+        Subscriber(chat['chat_id'], chat.get('locale', LOCALE))
+        if isinstance(chat, dict) else Subscriber(chat, LOCALE)
+        for chat in chats
+    ]
+
+
+def load_tenants():
+    """Collect tenants from environment and TENANTS_FILE.
+    TENANTS_FILE is a JSON object mapping Practicum token to chat id,
+    object with chat_id and locale of the chat or a list of them.
+    TELEGRAM_CHAT_ID may list several chats separated by commas.
+    """
+    tenants = {}
+    if PRACTICUM_TOKEN and TELEGRAM_CHAT_ID:
+        chats = TELEGRAM_CHAT_ID
+        if ',' in str(chats):
+            chats = [chat.strip() for chat in chats.split(',')]
+        subscribers = _subscribers(chats)
+        tenants[PRACTICUM_TOKEN] = Tenant(
+            PRACTICUM_TOKEN, subscribers[0].chat_id, subscribers=subscribers
+        )
+    if TENANTS_FILE:
+        with open(TENANTS_FILE, encoding='utf-8') as file:
+            for token, chats in json.load(file).items():
+                subscribers = _subscribers(chats)
+                tenants[token] = Tenant(
+                    token, subscribers[0].chat_id, subscribers=subscribers
+                )
+    if shard is not None:
+        return [
+            tenant for tenant in tenants.values()
+            if shard.ring.shard(tenant.key) == shard.index
+        ]
+    return list(tenants.values())
+
+
+class MemoryStore:
+    """State of tenants kept in memory only, lost on restart."""
+
+    def restore(self, tenants):
+        """Load saved state into the tenants."""
+        return tenants
+
+    def save(self, tenants):
+        """Save state of the polled tenants."""
+
+    def close(self):
+        """Release the storage."""
+
+
+class SQLiteStore(MemoryStore):
+    """State of tenants in SQLite, so restart resumes from the last poll.
+    Polled tenants of one cycle are written in one WAL transaction.
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS tenants ('
+        'key TEXT PRIMARY KEY, timestamp INTEGER, failures TEXT)',
+        'CREATE TABLE IF NOT EXISTS homeworks ('
+        'tenant TEXT, homework TEXT, status TEXT, date_updated TEXT, '
+        'homework_name TEXT, PRIMARY KEY (tenant, homework))',
+    )
+
+    def __init__(self, path):
+        """Open database and create tables."""
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in self.SCHEMA:
+            self.connection.execute(statement)
+
+    def restore(self, tenants):
+        """Load saved timestamps, errors and statuses into the tenants."""
+        by_key = {tenant.key: tenant for tenant in tenants}
+        for key, timestamp, failures in self.connection.execute(
+            'SELECT key, timestamp, failures FROM tenants'
+        ):
+            if (tenant := by_key.get(key)) is not None:
+                tenant.timestamp = timestamp
+                tenant.failures.load(failures)
+        for key, homework, status, date_updated, name in (
+            self.connection.execute(
+                'SELECT tenant, homework, status, date_updated, '
+                'homework_name FROM homeworks'
+            )
+        ):
+            if (tenant := by_key.get(key)) is not None:
+                homework = json.loads(homework)
+                tenant.statuses[homework] = Homework(
+                    homework, name and sys.intern(name), Status(status),
+                    date_updated
+                )
+        for tenant in tenants:
+            tenant.commit([])
+        logger.debug(f'State of {len(by_key)} tenants is restored')
+        return tenants
+
+    def save(self, tenants):
+        """Save state of the polled tenants in one transaction."""
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO tenants VALUES (?, ?, ?)',
+                [
+                    (tenant.key, tenant.timestamp, tenant.failures.dump())
+                    for tenant in tenants
+                ]
+            )
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO homeworks VALUES (?, ?, ?, ?, ?)',
+                [
+                    (tenant.key, json.dumps(homework.key),
+                     homework.status.value, homework.date_updated,
+                     homework.name)
+                    for tenant in tenants
+                    for homework in tenant.statuses.values()
+                ]
+            )
+
+    def close(self):
+        """Close database."""
+        self.connection.close()
+
+
+STATE_BACKENDS = {
+    'memory': MemoryStore,
+    'sqlite': SQLiteStore,
+}
+
+
+def open_store():
+    """State store chosen by STATE_BACKEND, memory without STATE_DB."""
+    if not STATE_DB:
+        logger.warning(
+            'Without STATE_DB state is kept in memory, '
+            'restart polls from the first timestamp'
+        )
+        return MemoryStore()
+    return STATE_BACKENDS[STATE_BACKEND](STATE_DB)
+
+
+StatusEvent = namedtuple('StatusEvent', (
+    'tenant', 'homework', 'name', 'status', 'comment', 'date_updated', 'seen'
+))
+
+
+def _epoch(date):
+    """Seconds since epoch of ISO date of the API, -1 when there is none."""
+    try:
+        return int(datetime.fromisoformat(date).timestamp())
+    except (TypeError, ValueError):
+        return -1
+
+
+class HistoryIndex:
+    """Memory-mapped index of the event log by tenant and homework name.
+    Buckets of two hash tables, by tenant and by tenant with name,
+    hold the last entries of their chains. Entries are appended after
+    the tables and keep offset of the record in the log, its date and
+    status, so a lookup reads only the pages of its chain.
+    """
+
+    MAGIC = b'HWINDEX1'
+    HEADER = struct.Struct('<8sQQ')
+    HEAD = struct.Struct('<Q')
+    ENTRY = struct.Struct('<QQQQQqB7x')
+
+    def __init__(self, path, buckets=INDEX_BUCKETS):
+        """Open the index, an index of other layout is reset."""
+        self.path = path
+        self.buckets = buckets
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.map = None
+        header = os.pread(self.fd, self.HEADER.size, 0)
+        if (
+            len(header) < self.HEADER.size
+            or self.HEADER.unpack(header)[:2] != (self.MAGIC, buckets)
+        ):
+            self.reset()
+        else:
+            self._remap()
+
+    @property
+    def covered(self):
+        """Size of the log the index covers."""
+        return self.HEADER.unpack_from(self.map)[2]
+
+    @staticmethod
+    def _hash(key):
+        """Hash of the key in the tables."""
+        return int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little'
+        )
+
+    def _bucket(self, table, key_hash):
+        """Position of the bucket of the hash in the table."""
+        return self.HEADER.size + self.HEAD.size * (
+            table * self.buckets + key_hash % self.buckets
+        )
+
+    def _remap(self):
+        """Map the whole file again after it has grown."""
+        if self.map is not None:
+            self.map.close()
+        self.map = mmap.mmap(self.fd, 0, access=mmap.ACCESS_READ)
+
+    def reset(self):
+        """Empty the index."""
+        os.ftruncate(self.fd, 0)
+        os.pwrite(self.fd, self.HEADER.pack(self.MAGIC, self.buckets, 0), 0)
+        os.ftruncate(
+            self.fd, self.HEADER.size + 2 * self.buckets * self.HEAD.size
+        )
+        self._remap()
+
+    def add(self, entries, covered):
+        """Index entries of the log.
+        Entry is (tenant, name, log offset, date, status index),
+        covered is the size of the log with them.
+        """
+        end = os.fstat(self.fd).st_size
+        heads = {}
+        chunks = []
+        for tenant, name, offset, date, status in entries:
+            tenant_hash = self._hash(tenant)
+            pair_hash = self._hash(f'{tenant}\0{name}')
+            tenant_bucket = self._bucket(0, tenant_hash)
+            pair_bucket = self._bucket(1, pair_hash)
+            chunks.append(self.ENTRY.pack(
+                pair_hash, tenant_hash, offset,
+                heads.get(pair_bucket) or self._head(pair_bucket),
+                heads.get(tenant_bucket) or self._head(tenant_bucket),
+                date, status
+            ))
+            heads[tenant_bucket] = heads[pair_bucket] = end + (
+                len(chunks) - 1
+            ) * self.ENTRY.size
+        os.pwrite(self.fd, b''.join(chunks), end)
+        for bucket, head in heads.items():
+            os.pwrite(self.fd, self.HEAD.pack(head), bucket)
+        os.pwrite(
+            self.fd, self.HEADER.pack(self.MAGIC, self.buckets, covered), 0
+        )
+
+    def _head(self, bucket):
+        """Last entry of the chain of the bucket."""
+        return self.HEAD.unpack_from(self.map, bucket)[0]
+
+    def entries(self, tenant, name=None):
+        """Entries of the tenant or of its homework, newest first.
+        Entry is (pair hash, log offset, date, status index).
+        """
+        if name is None:
+            key_hash, table, match, link = self._hash(tenant), 0, 1, 4
+        else:
+            key_hash, table, match, link = (
+                self._hash(f'{tenant}\0{name}'), 1, 0, 3
+            )
+        position = self._head(self._bucket(table, key_hash))
+        while position:
+            if position + self.ENTRY.size > len(self.map):
+                self._remap()
+            entry = self.ENTRY.unpack_from(self.map, position)
+            if entry[match] == key_hash:
+                yield entry[0], entry[2], entry[5], entry[6]
+            position = entry[link]
+
+    def close(self):
+        """Unmap and close the file."""
+        self.map.close()
+        os.close(self.fd)
+
+
+class EventLog:
+    """Append-only log of status transitions in a compact binary file.
+    Record is its length, RECORD header and UTF-8 of the homework key,
+    name and reviewer comment. Torn tail of a crash is cut on open.
+    Compaction drops repeated transitions once the file doubles.
+    HistoryIndex next to the log is rebuilt when it lags behind.
+    """
+
+    LENGTH = struct.Struct('<I')
+    RECORD = struct.Struct('<16sqdBHHI')
+    STATUSES = tuple(Status)
+
+    def __init__(self, path, compact=EVENT_LOG_COMPACT):
+        """Open the log for appending."""
+        self.path = path
+        self.compact_size = compact
+        self.lock = threading.Lock()
+        self.index = HistoryIndex(f'{path}.idx')
+        covered = self.index.covered
+        if covered > self._file_size():
+            covered = 0
+        size = self._valid_size(covered)
+        self.file = open(path, 'ab')
+        self.file.truncate(size)
+        self.file.seek(size)
+        self.compacted = size
+        self.reader = None
+        self.map = None
+        if self.index.covered != size:
+            self._reindex(covered)
+
+    def _file_size(self):
+        """Size of the log file, zero when there is none."""
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def _valid_size(self, start=0):
+        """Size of the log without a torn tail.
+        Log up to start is covered by the index, it is not read.
+        """
+        size = start
+        for _, end in self._records(start):
+            size = end
+        return size
+
+    def _records(self, start=0):
+        """Payloads of the records from start and their ends in the file."""
+        try:
+            with open(self.path, 'rb') as file:
+                file.seek(start)
+                data = file.read()
+        except FileNotFoundError:
+            return
+        offset = 0
+        while offset + self.LENGTH.size <= len(data):
+            length, = self.LENGTH.unpack_from(data, offset)
+            begin = offset + self.LENGTH.size
+            if begin + length > len(data):
+                return
+            offset = begin + length
+            yield data[begin:offset], start + offset
+
+    def _reindex(self, start=0):
+        """Index the log from start, the whole log by default."""
+        if not start:
+            self.index.reset()
+        entries, size = [], start
+        for payload, size in self._records(start):
+            entries.append(self._entry(
+                self._decode(payload), size - len(payload) - self.LENGTH.size
+            ))
+        self.index.add(entries, size)
+        logger.info(f'History index is built for {len(entries)} events')
+
+    def _entry(self, event, offset):
+        """Index entry of the event written at the offset."""
+        return (
+            event.tenant, event.name, offset, event.date_updated,
+            self.STATUSES.index(event.status)
+        )
+
+    def _encode(self, event):
+        """Record of the event."""
+        key, name, comment = (
+            value.encode() for value in
+            (json.dumps(event.homework), event.name, event.comment)
+        )
+        payload = self.RECORD.pack(
+            bytes.fromhex(event.tenant), event.date_updated, event.seen,
+            self.STATUSES.index(event.status),
+            len(key), len(name), len(comment)
+        ) + key + name + comment
+        return self.LENGTH.pack(len(payload)) + payload
+
+    def _decode(self, payload):
+        """Event of the record."""
+        tenant, date, seen, status, *lengths = self.RECORD.unpack_from(payload)
+        values, offset = [], self.RECORD.size
+        for length in lengths:
+            values.append(payload[offset:offset + length].decode())
+            offset += length
+        key, name, comment = values
+        return StatusEvent(
+            tenant.hex(), json.loads(key), name, self.STATUSES[status],
+            comment, date, seen
+        )
+
+    def append(self, tenant, changes):
+        """Write transitions of the tenant, changes as of Tenant.changes."""
+        if not changes:
+            return
+        seen = time.time()
+        events = [
+            StatusEvent(
+                tenant.key, homework.key, homework.name, homework.status,
+                raw.get('reviewer_comment') or '',
+                _epoch(homework.date_updated), seen
+            )
+            for homework, raw in changes
+        ]
+        records = [self._encode(event) for event in events]
+        with self.lock:
+            offset = self.file.tell()
+            self.file.write(b''.join(records))
+            self.file.flush()
+            entries = []
+            for event, record in zip(events, records):
+                entries.append(self._entry(event, offset))
+                offset += len(record)
+            self.index.add(entries, offset)
+            if offset > max(self.compact_size, 2 * self.compacted):
+                self._compact()
+
+    def _event_at(self, offset):
+        """Event of the record at the offset, read through mmap."""
+        if self.map is None or offset >= len(self.map):
+            self._close_reader()
+            self.reader = open(self.path, 'rb')
+            self.map = mmap.mmap(
+                self.reader.fileno(), 0, access=mmap.ACCESS_READ
+            )
+        length, = self.LENGTH.unpack_from(self.map, offset)
+        start = offset + self.LENGTH.size
+        return self._decode(self.map[start:start + length])
+
+    def _close_reader(self):
+        """Unmap the log."""
+        if self.map is not None:
+            self.map.close()
+            self.reader.close()
+            self.map = self.reader = None
+
+    def history(self, tenant, name=None, limit=None):
+        """Events of the tenant key or of its homework, newest first.
+        Index only points to the records, a record of another tenant
+        or homework means the log was rewritten under it, so it is
+        skipped and the index is built again.
+        """
+        with self.lock:
+            events, stale = self._lookup(tenant, name, limit)
+            if stale:
+                logger.warning('History index does not match the log')
+                self._close_reader()
+                self._reindex()
+                events, _ = self._lookup(tenant, name, limit)
+        return events
+
+    def _lookup(self, tenant, name, limit):
+        """Events of the index entries and whether some did not match."""
+        events, stale = [], False
+        for _, offset, _, _ in self.index.entries(tenant, name):
+            try:
+                event = self._event_at(offset)
+            except (struct.error, ValueError):
+                event = None
+            if event is None or event.tenant != tenant or (
+                name is not None and event.name != name
+            ):
+                stale = True
+                continue
+            events.append(event)
+            if len(events) == limit:
+                break
+        return events, stale
+
+    def reviewing_times(self, tenant, name=None):
+        """Seconds homeworks of the tenant key spent in review.
+        Only dates and statuses of the index are read, not the log.
+        """
+        verdicts = {}
+        times = []
+        reviewing = self.STATUSES.index(Status.REVIEWING)
+        with self.lock:
+            for pair, _, date, status in self.index.entries(tenant, name):
+                if status != reviewing:
+                    verdicts[pair] = date
+                elif pair in verdicts and min(date, verdicts[pair]) >= 0:
+                    times.append(verdicts.pop(pair) - date)
+        return times
+
+    def replay(self):
+        """Events of the log in the order they were written."""
+        with self.lock:
+            self.file.flush()
+        for payload, _ in self._records():
+            yield self._decode(payload)
+
+    def state(self):
+        """Latest event of every homework of every tenant."""
+        state = {}
+        for event in self.replay():
+            state.setdefault(event.tenant, {})[event.homework] = event
+        return state
+
+    def restore(self, tenants):
+        """Fill statuses of tenants without state from the log.
+        Index gives the latest event of every homework of the tenant,
+        only those events are read from the log.
+        """
+        with self.lock:
+            for tenant in tenants:
+                if tenant.statuses:
+                    continue
+                for event in self._latest(tenant.key):
+                    tenant.statuses[event.homework] = Homework(
+                        event.homework, sys.intern(event.name), event.status,
+                        None
+                    )
+                tenant.commit([])
+        return tenants
+
+    def _latest(self, tenant):
+        """Latest events of the homeworks of the tenant key.
+        Homeworks are told apart by name, as in the index.
+        """
+        latest = {}
+        for pair, offset, _, _ in self.index.entries(tenant):
+            latest.setdefault(pair, offset)
+        events = []
+        for offset in latest.values():
+            try:
+                event = self._event_at(offset)
+            except (struct.error, ValueError):
+                continue
+            if event.tenant == tenant:
+                events.append(event)
+        return events
+
+    def _compact(self):
+        """Rewrite the log without repeated transitions."""
+        seen = set()
+        records = []
+        for payload, _ in self._records():
+            event = self._decode(payload)
+            transition = (
+                event.tenant, json.dumps(event.homework), event.status,
+                event.date_updated
+            )
+            if transition not in seen:
+                seen.add(transition)
+                records.append(self.LENGTH.pack(len(payload)) + payload)
+        self.file.close()
+        with open(f'{self.path}.compact', 'wb') as file:
+            file.write(b''.join(records))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f'{self.path}.compact', self.path)
+        self._close_reader()
+        self.file = open(self.path, 'ab')
+        self.compacted = self.file.tell()
+        self._reindex()
+        logger.info(f'Event log is compacted to {len(records)} records')
+
+    def close(self):
+        """Close the files."""
+        with self.lock:
+            self._close_reader()
+            self.index.close()
+            self.file.close()
+
+
+event_log = ContextVar('event_log', default=None)
+
+
+def open_event_log(tenants):
+    """Open EVENT_LOG and restore the tenants from it, None without it."""
+    if not EVENT_LOG:
+        return None
+    log = EventLog(EVENT_LOG)
+    log.restore(tenants)
+    return log
+
+
+def create_session(pool_size=HTTP_POOL_SIZE):
+    """Keep-alive session with a pool of connections to ENDPOINT."""
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=pool_size
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
 def check_tokens():
     """Check validity all tokens."""
+    if TENANTS_FILE:
+        return bool(TELEGRAM_TOKEN)
     return all([PRACTICUM_TOKEN, TELEGRAM_TOKEN, TELEGRAM_CHAT_ID])
 
 
+def _chat_id():
+    """Chat being sent to, chat of the polled tenant or TELEGRAM_CHAT_ID."""
+    if (chat_id := current_chat.get()) is not None:
+        return chat_id
+    tenant = current_tenant.get()
+    return TELEGRAM_CHAT_ID if tenant is None else tenant.chat_id
+
+
+@metrics.timed('send_message_seconds')
 def send_message(bot, message):
-    """Send messages and check validity messages."""
+    """Send messages and check validity messages.
+    Failure is logged and raised again, so the sender can retry.
+    """
+    chat_id = _chat_id()
     try:
         bot.send_message(
-            TELEGRAM_CHAT_ID,
+            chat_id,
             message
         )
-        logger.debug('Success send message')
-    except Exception:
+    except Exception as error:
+        metrics.inc(
+            'errors_total', stage='send', type=type(error).__name__
+        )
         logger.error(
-            'Error send message {TELEGRAM_CHAT_ID} : {message}'
+            f'Error send message {chat_id} : {message}'
+        )
+        raise
+    metrics.inc('messages_sent_total')
+    logger.debug('Success send message')
+
+
+class CircuitOpenError(BotError):
+    """Upstream is failing, call is not made."""
+
+    def __init__(self, upstream):
+        """Name the upstream in the message."""
+        super().__init__(f'Сервис {upstream} недоступен')
+        self.upstream = upstream
+
+
+class CircuitBreaker:
+    """Stops calls to an upstream after `failures` failures in a row.
+    Open breaker fails fast, once per cooldown it lets one probe call
+    through half-open: success closes it, failure opens it again.
+    Zero failures disables the breaker.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 'closed', 'half_open', 'open'
+    LEVELS = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name, failures=BREAKER_FAILURES,
+                 cooldown=BREAKER_COOLDOWN):
+        """Start closed."""
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failed = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def wait(self, now=None):
+        """Seconds until a call is allowed, zero lets the call through."""
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if self.state == self.CLOSED:
+                return 0
+            wait = self.opened + self.cooldown - now
+            if wait > 0:
+                return wait
+            self.opened = now
+            if self.state == self.OPEN:
+                self._transition(self.HALF_OPEN)
+            return 0
+
+    def check(self, now=None):
+        """Raise CircuitOpenError unless a call is allowed."""
+        if self.wait(now):
+            raise CircuitOpenError(self.name)
+
+    def success(self):
+        """Close the breaker after a successful call."""
+        with self.lock:
+            self.failed = 0
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def failure(self, now=None):
+        """Count failed call, open the breaker when there are too many."""
+        with self.lock:
+            self.failed += 1
+            if self.state == self.HALF_OPEN or (
+                self.state == self.CLOSED
+                and 0 < self.failures <= self.failed
+            ):
+                self.opened = time.monotonic() if now is None else now
+                self._transition(self.OPEN)
+
+    def level(self):
+        """State as a number: 0 closed, 1 half-open, 2 open."""
+        return self.LEVELS[self.state]
+
+    def _transition(self, state):
+        """Switch state, report it to logs and metrics."""
+        logger.warning(
+            f'Circuit breaker {self.name}: {self.state} -> {state}',
+            extra={'breaker': self.name, 'state': state}
+        )
+        metrics.inc(
+            'breaker_transitions_total', breaker=self.name, state=state
         )
+        self.state = state
+
+
+practicum_breaker = ContextVar(
+    'practicum_breaker', default=CircuitBreaker('practicum', failures=0)
+)
+
+
+class TokenBucket:
+    """Rate limiter earning `rate` tokens per second."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, now=None):
+        """Start with a full bucket of one second of tokens."""
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def wait(self, now):
+        """Seconds until a token is available."""
+        self.tokens = min(
+            self.tokens + (now - self.updated) * self.rate, self.capacity
+        )
+        self.updated = now
+        return max((1 - self.tokens) / self.rate, 0)
+
+    def take(self):
+        """Spend a token."""
+        self.tokens -= 1
+
+    def pause(self, seconds):
+        """Give no tokens for the seconds, as Telegram asked."""
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
 
 
+class SendQueue:
+    """Outbound Telegram messages sent by worker threads.
+    Pending messages of a chat are coalesced into one, sends respect
+    per-chat and global rate limits, 429 is retried after retry_after.
+    Workers send to different chats at once, a chat is sent to
+    by one worker at a time, so its messages keep their order.
+    While Telegram is down the breaker holds messages in the queue.
+    """
+
+    def __init__(self, bot, rate=TELEGRAM_RATE, chat_rate=CHAT_RATE,
+                 limit=None, workers=SEND_WORKERS, breaker=None):
+        """Start worker threads, limit may be shared with other processes."""
+        self.bot = bot
+        self.breaker = breaker or CircuitBreaker('telegram')
+        self.chat_rate = chat_rate
+        self.limit = TokenBucket(rate) if limit is None else limit
+        self.chat_limits = {}
+        self.pending = {}
+        self.order = deque()
+        self.sending = set()
+        self.sent = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.workers = [
+            threading.Thread(
+                target=self._run, name=f'telegram-sender-{index}',
+                daemon=True
+            )
+            for index in range(max(workers, 1))
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def __len__(self):
+        """Count pending messages."""
+        with self.condition:
+            return sum(map(len, self.pending.values()))
+
+    def put(self, chat_id, message, first=False):
+        """Queue message to the chat without waiting for Telegram."""
+        with self.condition:
+            if chat_id not in self.pending:
+                self.pending[chat_id] = deque()
+                self.order.append(chat_id)
+            if first:
+                self.pending[chat_id].appendleft(message)
+            else:
+                self.pending[chat_id].append(message)
+            self.condition.notify()
+
+    def close(self, timeout=5):
+        """Send pending messages and stop worker."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+
+    def _chat_limit(self, chat_id):
+        """Rate limiter of the chat."""
+        if chat_id not in self.chat_limits:
+            self.chat_limits[chat_id] = TokenBucket(self.chat_rate)
+        return self.chat_limits[chat_id]
+
+    def _ready(self, now):
+        """First chat allowed to be sent to now and seconds to wait."""
+        wait = self.limit.wait(now)
+        if wait:
+            return None, wait
+        for chat_id in self.order:
+            if chat_id in self.sending:
+                continue
+            if not (chat_wait := self._chat_limit(chat_id).wait(now)):
+                return chat_id, 0
+            wait = min(wait or chat_wait, chat_wait)
+        return None, wait or None
+
+    def _coalesce(self, chat_id):
+        """Take pending messages of the chat fitting into one message."""
+        messages = self.pending[chat_id]
+        text = messages.popleft()
+        while messages and len(text) + len(messages[0]) + 2 <= MESSAGE_LIMIT:
+            text = f'{text}\n\n{messages.popleft()}'
+        if not messages:
+            del self.pending[chat_id]
+            self.order.remove(chat_id)
+        return text
+
+    def _next(self):
+        """Wait for the next message allowed to be sent."""
+        with self.condition:
+            while self.order or not self.closed:
+                now = time.monotonic()
+                chat_id, wait = self._ready(now)
+                if chat_id is not None and not (
+                    wait := self.breaker.wait(now)
+                ):
+                    self.limit.take()
+                    self._chat_limit(chat_id).take()
+                    self.sending.add(chat_id)
+                    return chat_id, self._coalesce(chat_id)
+                self.condition.wait(wait)
+        return None, None
+
+    def _done(self, chat_id):
+        """Let other workers send to the chat."""
+        with self.condition:
+            self.sending.discard(chat_id)
+            self.condition.notify_all()
+
+    def _run(self):
+        """Send messages until the queue is closed and empty."""
+        while True:
+            chat_id, text = self._next()
+            if chat_id is None:
+                return
+            current_chat.set(chat_id)
+            try:
+                send_message(self.bot, text)
+            except Exception as error:
+                self._retry(chat_id, text, error)
+            else:
+                self.sent = time.monotonic()
+                self.breaker.success()
+            finally:
+                self._done(chat_id)
+
+    def _retry(self, chat_id, text, error):
+        """Queue message again when Telegram asks to retry later or is down.
+        Other answers of Telegram are errors of the message, not outages.
+        """
+        import requests
+
+        code = getattr(error, 'error_code', None)
+        if code == HTTPStatus.TOO_MANY_REQUESTS:
+            self._pause(chat_id, text, error)
+        if code is not None and code < HTTPStatus.INTERNAL_SERVER_ERROR:
+            self.breaker.success()
+            return
+        self.breaker.failure()
+        if code is not None or isinstance(
+            error, (requests.ConnectionError, requests.Timeout)
+        ):
+            self.put(chat_id, text, first=True)
+
+    def _pause(self, chat_id, text, error):
+        """Queue message again after retry_after of the chat."""
+        retry_after = error.result_json.get(
+            'parameters', {}
+        ).get('retry_after', 1)
+        logger.warning(f'Telegram asks to retry in {retry_after} s')
+        with self.condition:
+            self._chat_limit(chat_id).pause(retry_after)
+        self.put(chat_id, text, first=True)
+
+
+class SharedTokenBucket:
+    """TokenBucket in shared memory, one limit for worker processes."""
+
+    def __init__(self, rate, context=None):
+        """Start with a full bucket of one second of tokens."""
+        context = context or multiprocessing.get_context()
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.state = context.Array('d', [self.capacity, time.monotonic()])
+
+    def wait(self, now):
+        """Seconds until a token is available."""
+        with self.state.get_lock():
+            tokens, updated = self.state
+            tokens = min(tokens + (now - updated) * self.rate, self.capacity)
+            self.state[0], self.state[1] = tokens, now
+        return max((1 - tokens) / self.rate, 0)
+
+    def take(self):
+        """Spend a token."""
+        with self.state.get_lock():
+            self.state[0] -= 1
+
+    def pause(self, seconds):
+        """Give no tokens for the seconds, as Telegram asked."""
+        with self.state.get_lock():
+            self.state[0] = min(self.state[0], 1 - seconds * self.rate)
+
+
+class HashRing:
+    """Consistent hash of tenant keys over shards.
+    Adding or removing a shard moves only its share of tenants.
+    """
+
+    def __init__(self, shards, replicas=64):
+        """Put replicas of every shard on the ring."""
+        self.shards = shards
+        points = sorted(
+            (self._hash(f'{index}:{replica}'), index)
+            for index in range(shards)
+            for replica in range(replicas)
+        )
+        self.hashes = [point for point, _ in points]
+        self.owners = [index for _, index in points]
+
+    @staticmethod
+    def _hash(key):
+        """Position of the key on the ring."""
+        return int.from_bytes(
+            hashlib.blake2b(key.encode(), digest_size=8).digest(), 'big'
+        )
+
+    def shard(self, key):
+        """Shard owning the key."""
+        index = bisect.bisect(self.hashes, self._hash(key))
+        return self.owners[index % len(self.owners)]
+
+
+def _request_kwargs(timestamp):
+    """Headers and params of API request for the current tenant."""
+    tenant = current_tenant.get()
+    return {
+        'headers': HEADERS if tenant is None else tenant.headers,
+        'params': {'from_date': timestamp},
+    }
+
+
+class RetryBudget:
+    """Retries allowed to the process, a share of its requests.
+    Every request earns `ratio` of a retry, every retry spends one,
+    so during an outage retries add at most that share of load.
+    """
+
+    def __init__(self, ratio=RETRY_RATIO, reserve=RETRY_RESERVE):
+        """Start with the reserve of retries."""
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        """Earn a share of retry for a request."""
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.reserve)
+
+    def withdraw(self):
+        """Spend a retry, tell if there was one."""
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class LatencyWindow:
+    """Latencies of the last requests and their quantiles."""
+
+    def __init__(self, size=LATENCY_WINDOW):
+        """Start empty."""
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds):
+        """Remember latency of a request."""
+        self.samples.append(seconds)
+
+    def quantile(self, share=HEDGE_QUANTILE):
+        """Latency below which the share of requests fit, None if unknown."""
+        if len(self.samples) < HEDGE_SAMPLES:
+            return None
+        samples = sorted(self.samples)
+        return samples[min(int(len(samples) * share), len(samples) - 1)]
+
+
+retry_budget = RetryBudget()
+api_latency = LatencyWindow()
+
+
+@functools.cache
+def _hedge_executor():
+    """Threads of hedged requests."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    return ThreadPoolExecutor(
+        max(HTTP_POOL_SIZE, 2), thread_name_prefix='hedge'
+    )
+
+
+def _hedged_get(http, kwargs):
+    """GET which sends a second request when the first is slower than p95.
+    First successful answer wins, the other one is left to finish.
+    """
+    from concurrent.futures import FIRST_COMPLETED, wait
+
+    delay = api_latency.quantile()
+    if delay is None:
+        return http.get(ENDPOINT, **kwargs)
+    executor = _hedge_executor()
+    pending = {executor.submit(http.get, ENDPOINT, **kwargs)}
+    done, pending = wait(pending, timeout=delay)
+    if not done:
+        metrics.inc('hedged_requests_total')
+        pending.add(executor.submit(http.get, ENDPOINT, **kwargs))
+    while True:
+        if not done:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        future = done.pop()
+        if future.exception() is None or not (done or pending):
+            return future.result()
+
+
+def _fetch(http, kwargs):
+    """Answer of the API within timeouts.
+    Connection errors and timeouts are retried with backoff
+    while there are attempts and retry budget left. Only the request
+    earns the budget, its retries do not.
+    """
+    import requests
+
+    get = _hedged_get if HEDGE_REQUESTS else (
+        lambda http, kwargs: http.get(ENDPOINT, **kwargs)
+    )
+    kwargs = {**kwargs, 'timeout': (CONNECT_TIMEOUT, READ_TIMEOUT)}
+    attempt = 0
+    retry_budget.deposit()
+    while True:
+        started = time.perf_counter()
+        try:
+            response = get(http, kwargs)
+        except (requests.ConnectionError, requests.Timeout) as error:
+            attempt += 1
+            if attempt > RETRIES or not retry_budget.withdraw():
+                raise
+            delay = random.uniform(0, RETRY_BACKOFF * 2 ** (attempt - 1))
+            logger.warning(f'Retry {attempt} in {delay:.2f} s: {error}')
+            metrics.inc('retries_total')
+            time.sleep(delay)
+        else:
+            api_latency.add(time.perf_counter() - started)
+            return response
+
+
+def _is_unchanged(headers, body):
+    """Tell if the answer for the current tenant repeats the last one."""
+    tenant = current_tenant.get()
+    if tenant is None or not tenant.is_unchanged(headers or {}, body):
+        return False
+    metrics.inc('short_circuited_total')
+    return True
+
+
+def _fields(values, fields):
+    """Keep only the fields of a dict, other values are kept as they are."""
+    if not isinstance(values, dict):
+        return values
+    return {field: values[field] for field in fields if field in values}
+
+
+def _select_fields(answer):
+    """Keep only fields of the answer and of its homeworks used by the bot."""
+    answer = _fields(answer, ANSWER_FIELDS)
+    if isinstance(answer, dict) and isinstance(answer.get('homeworks'), list):
+        answer['homeworks'] = [
+            _fields(homework, HOMEWORK_FIELDS)
+            for homework in answer['homeworks']
+        ]
+    return answer
+
+
+def _msgspec_decoder(msgspec):
+    """Decoder building only used fields of the answer and its homeworks.
+    Structs declare only them, the parser skips other fields unbuilt.
+    Answer of another shape is decoded whole for check_response.
+    """
+    unset = msgspec.UNSET
+    homework_fields = msgspec.defstruct('HomeworkFields', [
+        (field, object, unset) for field in HOMEWORK_FIELDS
+    ])
+    answer_fields = msgspec.json.Decoder(msgspec.defstruct('AnswerFields', [
+        ('homeworks', list[homework_fields], unset),
+        ('current_date', object, unset),
+    ]))
+
+    def values(struct):
+        return {
+            field: value for field in struct.__struct_fields__
+            if (value := getattr(struct, field)) is not unset
+        }
+
+    def select(body):
+        try:
+            answer = values(answer_fields.decode(body))
+        except msgspec.ValidationError:
+            return _select_fields(msgspec.json.decode(body))
+        if 'homeworks' in answer:
+            answer['homeworks'] = list(map(values, answer['homeworks']))
+        return answer
+
+    def decode(body):
+        try:
+            return select(body)
+        except msgspec.DecodeError as error:
+            raise ValueError(error) from error
+
+    return decode
+
+
+@functools.cache
+def answer_decoder():
+    """Fastest installed decoder of answer bytes: msgspec, orjson or json.
+    Only msgspec skips unused fields while parsing, orjson and json
+    build the whole tree and unused fields are dropped after it.
+    Every decoder raises ValueError on a broken body.
+    """
+    try:
+        import msgspec
+    except ImportError:
+        pass
+    else:
+        return _msgspec_decoder(msgspec)
+    try:
+        import orjson
+    except ImportError:
+        return lambda body: _select_fields(json.loads(body))
+    return lambda body: _select_fields(orjson.loads(body))
+
+
+def _record_status(status):
+    """Count 5xx answers as failures of Practicum, others as success.
+    Answer 200 is a success only once it is decoded, see _decode_answer.
+    """
+    if status >= HTTPStatus.INTERNAL_SERVER_ERROR:
+        practicum_breaker.get().failure()
+    elif status != HTTPStatus.OK:
+        practicum_breaker.get().success()
+
+
+def _decode_answer(body, fallback=None):
+    """Decode answer 200, a broken body is a failure of Practicum.
+    Without body the answer comes from fallback, json of the response.
+    """
+    try:
+        with metrics.timer('json_decode_seconds'):
+            answer = fallback() if body is None else answer_decoder()(body)
+    except ValueError as error:
+        practicum_breaker.get().failure()
+        raise ResponseDecodeError(f'Ответ API не разобран: {error}')
+    practicum_breaker.get().success()
+    return answer
+
+
+@metrics.timed('get_api_answer_seconds')
 def get_api_answer(timestamp):
     """Docstring to pass tests.
-    The name of the function speaks about the essence
+    The name of the function speaks about the essence.
+    Request goes through the session of the runtime when there is one.
+    Answer same as the last one is not decoded, UNCHANGED is returned.
+    Other answers are decoded from raw bytes by answer_decoder.
+    While Practicum is down the breaker fails fast without a request.
+    Requests have timeouts, lost connections are retried, slow ones
+    may be hedged, see _fetch.
     """
-    params = {'from_date': timestamp}
+    import requests
+
+    practicum_breaker.get().check()
+    http = http_session.get() or requests
     try:
-        response = requests.get(
-            ENDPOINT,
-            headers=HEADERS,
-            params=params
-        )
+        response = _fetch(http, _request_kwargs(timestamp))
     except Exception as error:
-        raise Exception(f'Ошибка в ответе API:{error}')
+        practicum_breaker.get().failure()
+        raise APIRequestError(f'Ошибка в ответе API:{error}')
+    _record_status(response.status_code)
+    if response.status_code == HTTPStatus.NOT_MODIFIED:
+        metrics.inc('short_circuited_total')
+        return UNCHANGED
     if response.status_code != HTTPStatus.OK:
-        raise Exception(f'Ошибка в статусе ответа:{response}')
-    return response.json()
+        raise APIStatusError(response.status_code)
+    body = getattr(response, 'content', None)
+    if _is_unchanged(getattr(response, 'headers', None), body):
+        practicum_breaker.get().success()
+        return UNCHANGED
+    return _decode_answer(body, response.json)
+
+
+async def get_api_answer_async(timestamp, session=None):
+    """Async get_api_answer over aiohttp session.
+    Without session blocking get_api_answer is called in a thread,
+    it is timed by itself.
+    """
+    import asyncio
+
+    if session is None:
+        return await asyncio.to_thread(get_api_answer, timestamp)
+    return await _get_api_answer_aiohttp(timestamp, session)
+
+
+@metrics.timed('get_api_answer_seconds')
+async def _get_api_answer_aiohttp(timestamp, session):
+    """Answer of the API over aiohttp session."""
+    import asyncio
+
+    import aiohttp
+
+    practicum_breaker.get().check()
+    try:
+        async with session.get(
+            ENDPOINT, **_request_kwargs(timestamp)
+        ) as response:
+            _record_status(response.status)
+            if response.status == HTTPStatus.NOT_MODIFIED:
+                metrics.inc('short_circuited_total')
+                return UNCHANGED
+            if response.status != HTTPStatus.OK:
+                raise APIStatusError(response.status)
+            body = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+        practicum_breaker.get().failure()
+        raise APIRequestError(f'Ошибка в ответе API:{error}')
+    if _is_unchanged(response.headers, body):
+        practicum_breaker.get().success()
+        return UNCHANGED
+    return _decode_answer(body)
 
 
 def check_response(response):
-    """Warlus method more quality.
+    """Return all homeworks of the answer.
+    Warlus method more quality.
     But tests give me error: Make sure what 'check_response'
     checks type response. Right version:
     if (homeworks := response.get['homeworks']) is None:
@@ -96,59 +1997,765 @@ def check_response(response):
     try:
         homeworks = response['homeworks']
     except KeyError:
-        raise KeyError('Ответ не содержит заданий')
+        raise ResponseKeyError('Ответ не содержит заданий')
     if not isinstance(homeworks, list):
-        raise TypeError('Тип списка домашки - не list')
-    try:
-        homework = homeworks[0]
-    except IndexError:
-        raise IndexError('В списке домашинх работ нет домашек')
-    return homework
+        raise ResponseTypeError('Тип списка домашки - не list')
+    return homeworks
 
 
+@metrics.timed('parse_status_seconds')
 def parse_status(homework):
-    """Generate answer on chat."""
-    if (homework_name := homework.get('homework_name')) is None:
-        logger.debug('Dict don`t have key {homework_name}')
-        raise KeyError('В словаре нет ключа {homework_name}')
-    if (status := homework.get('status')) is None:
-        raise KeyError(f'В словаре нет ключа {status}')
-    if status not in HOMEWORK_VERDICTS:
-        raise KeyError('Вердикт не определён: {homework_verdict}')
-    verdict = HOMEWORK_VERDICTS[status]
-    return f'Изменился статус проверки работы "{homework_name}". {verdict}'
+    """Generate answer on chat.
+    Homework is a Homework record or a dict of the API answer,
+    message is in the locale of the current tenant.
+    """
+    if not isinstance(homework, Homework):
+        homework = Homework.from_dict(homework)
+    tenant = current_tenant.get()
+    return catalog.format(
+        homework.status, homework.name,
+        LOCALE if tenant is None else tenant.locale
+    )
+
+
+def handle_answer(tenant, response):
+    """Return homeworks with new statuses of the tenant.
+    Messages in the locale of the tenant go to its history.
+    """
+    metrics.inc('polls_total')
+    tenant.errors = 0
+    tenant.idle += 1
+    if response is UNCHANGED:
+        logger.debug('Answer is not changed')
+        return []
+    answer = check_response(response)
+    changes = tenant.changes(answer)
+    if (log := event_log.get()) is not None:
+        log.append(tenant, changes)
+    homeworks = tenant.diff(changes)
+    metrics.inc('duplicates_suppressed_total', len(answer) - len(homeworks))
+    messages = [parse_status(homework) for homework in homeworks]
+    tenant.commit(homeworks)
+    tenant.timestamp = response.get('current_date', tenant.timestamp)
+    tenant.accept()
+    if not messages:
+        logger.debug('No new statuses')
+        return []
+    tenant.idle = 0
+    tenant.history.extend(messages)
+    return homeworks
+
+
+def handle_error(tenant, error):
+    """Return message about new kind of error of the tenant if there is one.
+    Repeats of the kind go to the digest of the error window.
+    Open breaker is logged without traceback, it is the same every poll.
+    """
+    if isinstance(error, CircuitOpenError):
+        logger.debug(error)
+    else:
+        logging.error(error, exc_info=True)
+    metrics.inc('polls_total')
+    metrics.inc('errors_total', stage='poll', type=type(error).__name__)
+    tenant.errors += 1
+    if not tenant.failures.add(error):
+        metrics.inc('duplicates_suppressed_total')
+        return []
+    return [f'Сбой в работе программы: {error}']
+
+
+def notify(outbox, tenant, messages):
+    """Queue messages to every chat of the tenant which is not paused.
+    Homework records are formatted in the locale of the chat,
+    once per locale thanks to the cache of the catalog.
+    """
+    for chat_id, locale in tenant.subscribers:
+        if str(chat_id) in tenant.paused:
+            logger.debug(f'Chat {chat_id} is paused')
+            continue
+        for message in messages:
+            if isinstance(message, Homework):
+                message = catalog.format(message.status, message.name, locale)
+            outbox.put(chat_id, message)
+
+
+def _history(tenants, log):
+    """Last transitions of the tenants.
+    With the event log they come from its index, and the average
+    time of review is added.
+    """
+    if log is None:
+        return [message for tenant in tenants for message in tenant.history]
+    lines = [
+        catalog.format(event.status, event.name, tenant.locale)
+        for tenant in tenants
+        for event in reversed(log.history(tenant.key, limit=HISTORY_SIZE))
+    ]
+    times = [
+        seconds for tenant in tenants
+        for seconds in log.reviewing_times(tenant.key)
+    ]
+    if times:
+        hours = sum(times) / len(times) / 3600
+        lines.append(f'Среднее время проверки: {hours:.1f} ч.')
+    return lines
+
+
+def answer_command(tenants, command, chat_id=None, log=None):
+    """Answer command of a chat from the state in memory.
+    Without chat id the command is from the main chat of the tenants.
+    History is taken from the event log when it is given.
+    """
+    if not tenants:
+        return 'Чат не подписан на статусы домашних работ.'
+    if command == 'pause':
+        chat_id = str(tenants[0].chat_id if chat_id is None else chat_id)
+        paused = chat_id not in tenants[0].paused
+        for tenant in tenants:
+            if paused:
+                tenant.paused.add(chat_id)
+            else:
+                tenant.paused.discard(chat_id)
+        if paused:
+            return 'Уведомления приостановлены, /pause чтобы продолжить.'
+        return 'Уведомления возобновлены.'
+    if command == 'history':
+        lines = _history(tenants, log)
+        return '\n\n'.join(lines) or 'Изменений статусов пока не было.'
+    lines = [
+        f'"{homework.name}": '
+        f'{catalog.verdict(homework.status, tenant.locale)}'
+        for tenant in tenants
+        for homework in list(tenant.statuses.values())
+    ]
+    return '\n'.join(lines) or 'Статусов домашних работ пока нет.'
+
+
+def share_telegram_session(pool_size=SEND_WORKERS):
+    """Send all Telegram requests over one pool of keep-alive connections.
+    Otherwise telebot opens a session in every thread.
+    """
+    from telebot import apihelper
+
+    if apihelper.session is None:
+        apihelper.session = create_session(pool_size)
+
+
+def webhook_route(bot, secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS):
+    """Route taking Telegram updates for the handlers of the bot.
+    Telegram is answered at once, updates are handled by a pool
+    of workers. Requests without the secret token are refused,
+    all of them when there is no secret.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from telebot.types import Update
+
+    executor = ThreadPoolExecutor(workers, thread_name_prefix='webhook')
+
+    def route(headers, read):
+        if not secret or (
+            headers.get('X-Telegram-Bot-Api-Secret-Token') != secret
+        ):
+            return HTTPStatus.FORBIDDEN, 'text/plain', 'Forbidden\n'
+        try:
+            update = Update.de_json(read().decode())
+        except (ValueError, KeyError, TypeError):
+            return HTTPStatus.BAD_REQUEST, 'text/plain', 'Bad update\n'
+        metrics.inc('webhook_updates_total')
+        executor.submit(bot.process_new_updates, [update])
+        return HTTPStatus.OK, 'application/json', '{}'
+
+    return route
+
+
+def start_commands(bot, tenants, outbox, routes=None):
+    """Serve /status, /history and /pause, replies go through the queue.
+    COMMANDS_MODE polling takes updates by long polling of Telegram,
+    webhook adds the route of WEBHOOK_URL to the routes of the service
+    endpoint and sets the webhook. Commands are answered from the
+    tenants of this process: to scale out run it with SHARDS, the
+    supervisor passes every update to the shard owning its chat.
+    """
+    if COMMANDS_MODE not in ('polling', 'webhook'):
+        return None
+    chats = {}
+    for tenant in tenants:
+        for subscriber in tenant.subscribers:
+            chats.setdefault(str(subscriber.chat_id), []).append(tenant)
+
+    log = event_log.get()
+
+    @bot.message_handler(commands=['status', 'history', 'pause'])
+    def reply(message):
+        command = message.text.split()[0].lstrip('/').split('@')[0]
+        outbox.put(
+            message.chat.id,
+            answer_command(
+                chats.get(str(message.chat.id), []), command,
+                message.chat.id, log
+            )
+        )
+
+    if COMMANDS_MODE == 'webhook':
+        return _start_webhook(bot, routes)
+    thread = threading.Thread(
+        target=bot.infinity_polling,
+        kwargs={'skip_pending': True},
+        name='telegram-commands',
+        daemon=True
+    )
+    thread.start()
+    return thread
+
+
+def _webhook_ready(routes):
+    """Whether webhook settings are complete, warn when they are not."""
+    if not (WEBHOOK_URL and WEBHOOK_SECRET) or (
+        SERVICE_PORT is None or routes is None
+    ):
+        logger.warning(
+            'Webhook needs WEBHOOK_URL, WEBHOOK_SECRET and SERVICE_PORT'
+        )
+        return False
+    return True
+
+
+def _set_webhook(bot):
+    """Tell Telegram to send updates to WEBHOOK_URL."""
+    bot.set_webhook(
+        url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET,
+        max_connections=WEBHOOK_WORKERS * 10
+    )
+    logger.info(f'Webhook is set to {urlsplit(WEBHOOK_URL).netloc}')
+
+
+def _start_webhook(bot, routes):
+    """Route updates of WEBHOOK_URL to the bot and tell Telegram about it.
+    Webhook of a shard is set by its supervisor.
+    """
+    if not _webhook_ready(routes):
+        return None
+    routes['POST', urlsplit(WEBHOOK_URL).path or '/'] = webhook_route(
+        bot, secret=WEBHOOK_SECRET
+    )
+    if shard is None:
+        _set_webhook(bot)
+    return None
+
+
+class ServiceHandler:
+    """Routes requests of the service endpoint of the bot.
+    Mixed into BaseHTTPRequestHandler when the endpoint starts,
+    so http.server is not imported with the module.
+    GET routes are keyed by path, POST routes by ('POST', path).
+    """
+
+    def do_GET(self):
+        """Answer with the route of the path."""
+        route = self.server.routes.get(urlsplit(self.path).path)
+        if route is None:
+            status, content_type, body = (
+                HTTPStatus.NOT_FOUND, 'text/plain', 'Not found\n'
+            )
+        else:
+            status, content_type, body = route()
+        self._reply(status, content_type, body)
+
+    def _reply(self, status, content_type, body):
+        """Send the answer."""
+        body = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        """Pass body of the request to the POST route of the path.
+        Route gets a function reading the body, so it may refuse the
+        request unread. Body is at most BODY_LIMIT bytes.
+        """
+        route = self.server.routes.get(('POST', urlsplit(self.path).path))
+        length = self.headers.get('Content-Length', '0')
+        if route is None:
+            answer = HTTPStatus.NOT_FOUND, 'text/plain', 'Not found\n'
+        elif not (length.isascii() and length.isdigit()):
+            answer = HTTPStatus.BAD_REQUEST, 'text/plain', 'Bad length\n'
+        elif int(length) > BODY_LIMIT:
+            answer = (
+                HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'text/plain',
+                'Too large\n'
+            )
+        else:
+            answer = route(self.headers, lambda: self.rfile.read(int(length)))
+        self._reply(*answer)
+
+    def log_message(self, format, *args):
+        """Log requests to the bot logger."""
+        logger.debug(format % args)
+
+
+def start_service(routes, port=None, host=None):
+    """Serve routes over HTTP in a daemon thread.
+    Port and host default to SERVICE_PORT and SERVICE_HOST,
+    nothing is served when there is no port.
+    """
+    port = SERVICE_PORT if port is None else port
+    host = SERVICE_HOST if host is None else host
+    if port is None:
+        return None
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    server = ThreadingHTTPServer((host, int(port)), type(
+        'ServiceHandler', (ServiceHandler, BaseHTTPRequestHandler), {}
+    ))
+    server.daemon_threads = True
+    server.routes = routes
+    threading.Thread(
+        target=server.serve_forever, name='service', daemon=True
+    ).start()
+    logger.debug(f'Service endpoint on {host}:{server.server_port}')
+    return server
+
+
+class Liveness:
+    """Heartbeat of the main cycle for the health endpoint.
+    Cycle beats after every poll and before it sleeps. It is stalled
+    when there is no beat for STALL_PERIODS cycles, a cycle is
+    expected to last the delay of the last sleep, at least RETRY_PERIOD.
+    """
+
+    __slots__ = ('beaten', 'delay', 'polled')
+
+    def __init__(self):
+        """Start with a beat and without polls."""
+        self.beaten = time.monotonic()
+        self.delay = 0
+        self.polled = None
+
+    def beat(self, delay=None):
+        """Cycle is alive, delay is the sleep it is going to."""
+        self.beaten = time.monotonic()
+        if delay is not None:
+            self.delay = delay
+
+    def poll(self):
+        """API answered."""
+        self.beat()
+        self.polled = self.beaten
+
+    def stalled(self, now=None):
+        """Whether the cycle missed too many beats."""
+        now = time.monotonic() if now is None else now
+        return now - self.beaten > STALL_PERIODS * max(
+            self.delay, RETRY_PERIOD
+        )
+
+
+liveness = ContextVar('liveness', default=Liveness())
+
+
+def _since(moment, now):
+    """Seconds since the moment, None if it never was."""
+    return None if moment is None else round(now - moment, 3)
+
+
+def health_routes(outbox, alive, breaker):
+    """Liveness and readiness routes.
+    /health fails when the cycle is stalled, so the worker is restarted,
+    /ready fails until the first answer of the API and while it is down.
+    """
+    def health():
+        now = time.monotonic()
+        stalled = alive.stalled(now)
+        report = {
+            'status': 'stalled' if stalled else 'ok',
+            'since_beat': _since(alive.beaten, now),
+            'since_poll': _since(alive.polled, now),
+            'since_send': _since(outbox.sent, now),
+            'send_queue': len(outbox),
+            'send_chats': len(outbox.pending),
+            'practicum_breaker': breaker.state,
+            'telegram_breaker': outbox.breaker.state,
+        }
+        return (
+            HTTPStatus.SERVICE_UNAVAILABLE if stalled else HTTPStatus.OK,
+            'application/json', json.dumps(report)
+        )
+
+    def ready():
+        if alive.polled is None or breaker.state == breaker.OPEN:
+            return HTTPStatus.SERVICE_UNAVAILABLE, 'text/plain', 'Not ready\n'
+        return HTTPStatus.OK, 'text/plain', 'Ready\n'
+
+    return {'/health': health, '/ready': ready}
+
+
+def service_routes(outbox):
+    """Routes of the service endpoint."""
+    metrics.gauge('send_queue_depth', outbox.__len__)
+    metrics.gauge('practicum_breaker_state', practicum_breaker.get().level)
+    metrics.gauge('telegram_breaker_state', outbox.breaker.level)
+    return {
+        '/metrics': lambda: (
+            HTTPStatus.OK, 'text/plain; version=0.0.4', metrics.render()
+        ),
+        **health_routes(outbox, liveness.get(), practicum_breaker.get()),
+    }
+
+
+def poll_tenant(outbox, tenant):
+    """Poll API for one tenant and queue messages about changes.
+    Digests of repeated errors go first.
+    """
+    token = current_tenant.set(tenant)
+    try:
+        digests = tenant.failures.flush()
+        try:
+            messages = handle_answer(
+                tenant, get_api_answer(tenant.timestamp)
+            )
+        except Exception as error:
+            messages = handle_error(tenant, error)
+            liveness.get().beat()
+        else:
+            liveness.get().poll()
+        notify(outbox, tenant, digests + messages)
+    finally:
+        current_tenant.reset(token)
+
+
+async def poll_tenant_async(outbox, tenant, session, semaphore):
+    """Async poll_tenant, semaphore bounds requests in flight.
+    Every task runs in its own context, so tenant is not reset.
+    """
+    current_tenant.set(tenant)
+    digests = tenant.failures.flush()
+    async with semaphore:
+        try:
+            messages = handle_answer(
+                tenant,
+                await get_api_answer_async(tenant.timestamp, session)
+            )
+        except Exception as error:
+            messages = handle_error(tenant, error)
+            liveness.get().beat()
+        else:
+            liveness.get().poll()
+        notify(outbox, tenant, digests + messages)
+
+
+async def main_async(tenants, store, outbox):
+    """Main cycle of bot on asyncio.
+    Due tenants are polled concurrently, at most MAX_CONCURRENCY
+    API calls are in flight at once.
+    """
+    import asyncio
+
+    scheduler = Scheduler(tenants)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+    try:
+        import aiohttp
+    except ImportError:
+        session = None
+        http_session.set(create_session(MAX_CONCURRENCY))
+    else:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=MAX_CONCURRENCY),
+            timeout=aiohttp.ClientTimeout(
+                sock_connect=CONNECT_TIMEOUT, sock_read=READ_TIMEOUT
+            )
+        )
+    try:
+        while True:
+            due = scheduler.pop_due(time.monotonic())
+            await asyncio.gather(*(
+                poll_tenant_async(outbox, tenant, session, semaphore)
+                for tenant in due
+            ))
+            store.save(due)
+            now = time.monotonic()
+            scheduler.reschedule(due, now)
+            delay = scheduler.delay(now)
+            liveness.get().beat(delay)
+            await asyncio.sleep(delay)
+    finally:
+        if session is not None:
+            await session.close()
+
+
+def run_shard(index, shards, limit):
+    """Worker process polling its shard of tenants with main().
+    SIGTERM stops it through finally of main(), so the state
+    is saved before another worker takes the tenants.
+    Every shard writes its own event log: the log is appended and
+    compacted by one process only.
+    """
+    global shard, SERVICE_PORT, COMMANDS_MODE, EVENT_LOG
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    setup_logging(filename=f'{LOG_FILE}.{index}')
+    shard = Shard(index, HashRing(shards), limit)
+    if SERVICE_PORT is not None:
+        SERVICE_PORT = int(SERVICE_PORT) + index + 1
+    if EVENT_LOG:
+        EVENT_LOG = f'{EVENT_LOG}.{index}'
+    if COMMANDS_MODE == 'polling':
+        logger.warning('Commands by polling are off in shards, use webhook')
+        COMMANDS_MODE = None
+    main()
+
+
+def _start_shards(shards, limit, context):
+    """Start worker processes for all shards."""
+    workers = []
+    for index in range(shards):
+        worker = context.Process(
+            target=run_shard, args=(index, shards, limit),
+            name=f'shard-{index}', daemon=True
+        )
+        worker.start()
+        workers.append(worker)
+    logger.info(f'Started {shards} shards')
+    return workers
+
+
+def _stop_shards(workers):
+    """Stop worker processes and wait until they save their state."""
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        worker.join()
+
+
+def _shard_url(index, path):
+    """URL of the path on the service endpoint of the shard."""
+    host = SERVICE_HOST
+    if host in ('', '0.0.0.0', '::'):
+        host = '127.0.0.1'
+    return f'http://{host}:{int(SERVICE_PORT) + index + 1}{path}'
+
+
+def _probe(url):
+    """Status of the health route of a shard."""
+    import urllib.error
+    import urllib.request
+
+    try:
+        with urllib.request.urlopen(url, timeout=CONNECT_TIMEOUT) as answer:
+            return json.loads(answer.read())['status']
+    except urllib.error.HTTPError as error:
+        if error.code == HTTPStatus.SERVICE_UNAVAILABLE:
+            return 'stalled'
+        return 'error'
+    except (OSError, ValueError, KeyError):
+        return 'down'
+
+
+def supervisor_routes(workers):
+    """Health of the shards on SERVICE_PORT of the supervisor.
+    Shard serves its routes on SERVICE_PORT + index + 1, the health
+    fails when any shard is dead or its health fails.
+    """
+    def health():
+        shards = [
+            _probe(_shard_url(index, '/health'))
+            if worker.is_alive() else 'dead'
+            for index, worker in enumerate(workers)
+        ]
+        healthy = all(status == 'ok' for status in shards)
+        return (
+            HTTPStatus.OK if healthy else HTTPStatus.SERVICE_UNAVAILABLE,
+            'application/json',
+            json.dumps({
+                'status': 'ok' if healthy else 'failing', 'shards': shards
+            })
+        )
+
+    return {'/health': health}
+
+
+def _update_chat(update):
+    """Chat id of the message of the Telegram update, None without it."""
+    message = update.get('message') or update.get('edited_message') or {}
+    return message.get('chat', {}).get('id')
+
+
+def _forward(url, body):
+    """Post the update to a shard, tell if the shard took it."""
+    import urllib.request
+
+    request = urllib.request.Request(url, data=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET,
+    })
+    try:
+        with urllib.request.urlopen(request, timeout=CONNECT_TIMEOUT):
+            return True
+    except OSError as error:
+        logger.error(f'Update is not passed to {url}: {error}')
+        return False
+
+
+def forward_route(workers, tenants):
+    """Route of the supervisor passing Telegram updates to the shards.
+    Update goes to every shard owning a tenant of its chat, updates
+    of other chats go to the first shard, it answers them as unknown.
+    """
+    owners = {}
+    for tenant in tenants:
+        for subscriber in tenant.subscribers:
+            owners.setdefault(str(subscriber.chat_id), []).append(tenant.key)
+    path = urlsplit(WEBHOOK_URL).path or '/'
+    rings = {}
+
+    def route(headers, read):
+        if not WEBHOOK_SECRET or (
+            headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET
+        ):
+            return HTTPStatus.FORBIDDEN, 'text/plain', 'Forbidden\n'
+        body = read()
+        try:
+            chat_id = _update_chat(json.loads(body))
+        except (ValueError, TypeError, AttributeError):
+            return HTTPStatus.BAD_REQUEST, 'text/plain', 'Bad update\n'
+        if (ring := rings.get(len(workers))) is None:
+            ring = rings[len(workers)] = HashRing(len(workers))
+        shards = {
+            ring.shard(key) for key in owners.get(str(chat_id), [])
+        } or {0}
+        if not all([_forward(_shard_url(index, path), body)
+                    for index in sorted(shards)]):
+            return HTTPStatus.SERVICE_UNAVAILABLE, 'text/plain', 'Retry\n'
+        return HTTPStatus.OK, 'application/json', '{}'
+
+    return route
+
+
+def _start_supervisor_webhook(routes, workers):
+    """Pass updates of WEBHOOK_URL to the shards and set the webhook."""
+    if COMMANDS_MODE != 'webhook' or not _webhook_ready(routes):
+        return
+    from telebot import TeleBot
+
+    routes['POST', urlsplit(WEBHOOK_URL).path or '/'] = forward_route(
+        workers, load_tenants()
+    )
+    _set_webhook(TeleBot(token=TELEGRAM_TOKEN))
+
+
+def run_supervisor(shards):
+    """Shard tenants over worker processes by consistent hash.
+    Workers share one Telegram rate limit. SIGTTIN adds a worker,
+    SIGTTOU removes one: old workers stop and save state before new
+    ones start, so no tenant is polled twice or notified twice.
+    Dead workers are restarted. SIGTERM stops the workers before
+    the supervisor exits, so none of them outlives it.
+    Health of all the workers is served on SERVICE_PORT, and with
+    COMMANDS_MODE webhook updates are passed to the owning shards.
+    """
+    if not STATE_DB:
+        logger.warning('Without STATE_DB moved tenants resend last status')
+    context = multiprocessing.get_context('spawn')
+    limit = SharedTokenBucket(TELEGRAM_RATE, context)
+    wanted = [shards]
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    signal.signal(signal.SIGTTIN, lambda *args: wanted.append(wanted[-1] + 1))
+    signal.signal(
+        signal.SIGTTOU, lambda *args: wanted.append(max(wanted[-1] - 1, 1))
+    )
+    workers = _start_shards(shards, limit, context)
+    routes = supervisor_routes(workers)
+    _start_supervisor_webhook(routes, workers)
+    service = start_service(routes)
+    try:
+        while True:
+            if wanted[-1] != len(workers):
+                _stop_shards(workers)
+                workers[:] = _start_shards(wanted[-1], limit, context)
+            for index, worker in enumerate(workers):
+                if not worker.is_alive():
+                    logger.error(f'Shard {index} exited, restarting')
+                    _stop_shards([worker])
+                    workers[index] = context.Process(
+                        target=run_shard, args=(index, len(workers), limit),
+                        name=f'shard-{index}', daemon=True
+                    )
+                    workers[index].start()
+            time.sleep(1)
+    finally:
+        if service is not None:
+            service.shutdown()
+        _stop_shards(workers)
 
 
 def main():
     """Main cycle of bot.
-    Status и error_message defined in beginning of the function.
-    When cycle is running, not send repeated messages.
+    All tenants are polled from one process: scheduler gives
+    tenants which are due, then cycle sleeps until the nearest poll.
+    Every status change is sent once, errors are not repeated.
+    Messages go through the queue, so Telegram never blocks polling.
+    Commands of the chats are answered from the state of the tenants.
+    Several tenants share warm connections of one session,
+    a single tenant polls rarer than any keep-alive lives.
+    State is saved after every cycle, so restart resumes from it.
+    Logging, HTTP and Telegram clients are set up here, not on import.
+    Cycle beats for the health endpoint, which fails when it stalls.
+    With SHARDS > 1 it supervises worker processes running main().
     """
+    setup_logging()
     if not check_tokens():
         logger.critical('One or more environment variables are missing')
         raise Exception('Один или несколько токенов утеряны')
+    load_messages()
+    if SHARDS > 1 and shard is None:
+        return run_supervisor(SHARDS)
+    from telebot import TeleBot
+
     bot = TeleBot(token=TELEGRAM_TOKEN)
-    timestamp = FIRST_TIMESTAMP
-    previous_message = ''
-    previous_error_message = ''
-    while True:
-        try:
-            response = get_api_answer(timestamp)
-            message = parse_status(check_response(response))
-            timestamp = response.get('current_date', timestamp)
-            if message == previous_message:
-                continue
-            send_message(bot, message)
-            previous_message = message
-        except Exception as error:
-            logging.error(error, exc_info=True)
-            message_error = f'Сбой в работе программы: {error}'
-            if message_error == previous_error_message:
-                continue
-            send_message(bot, message_error)
-            previous_error_message = message_error
-        finally:
-            time.sleep(RETRY_PERIOD)
+    share_telegram_session()
+    store = open_store()
+    outbox = SendQueue(bot, limit=shard and shard.limit)
+    service = None
+    tenants = []
+    breaker = practicum_breaker.set(CircuitBreaker('practicum'))
+    alive = liveness.set(Liveness())
+    journal = event_log.set(None)
+    try:
+        tenants = store.restore(load_tenants())
+        event_log.set(open_event_log(tenants))
+        routes = service_routes(outbox)
+        start_commands(bot, tenants, outbox, routes)
+        service = start_service(routes)
+        if ASYNC_MODE:
+            import asyncio
+
+            return asyncio.run(main_async(tenants, store, outbox))
+        scheduler = Scheduler(tenants)
+        logger.debug(f'Polling {len(scheduler)} tenants')
+        if len(scheduler) > 1:
+            http_session.set(create_session())
+        while True:
+            due = scheduler.pop_due(time.monotonic())
+            for tenant in due:
+                poll_tenant(outbox, tenant)
+            store.save(due)
+            now = time.monotonic()
+            scheduler.reschedule(due, now)
+            delay = scheduler.delay(now)
+            liveness.get().beat(delay)
+            time.sleep(delay)
+    finally:
+        if service is not None:
+            service.shutdown()
+        outbox.close()
+        store.save(tenants)
+        store.close()
+        if event_log.get() is not None:
+            event_log.get().close()
+        event_log.reset(journal)
+        liveness.reset(alive)
+        practicum_breaker.reset(breaker)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,1346 @@
+import asyncio
+import http.client
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+import requests
+import telebot
+
+import tests.check_utils as check_utils
+
+
+class TestTenants:
+
+    def test_scheduler_spreads_first_polls(self, homework_module):
+        tenants = [
+            homework_module.Tenant(str(index), index) for index in range(4)
+        ]
+        scheduler = homework_module.Scheduler(tenants, period=600, now=0)
+        assert scheduler.pop_due(0) == tenants[:1]
+        assert scheduler.delay(0) == 150
+        assert scheduler.pop_due(450) == tenants[1:]
+        scheduler.push(tenants[0], 600)
+        assert scheduler.delay(450) == 150
+
+    def test_load_tenants_from_file(self, homework_module, monkeypatch,
+                                    tmp_path):
+        path = tmp_path / 'tenants.json'
+        path.write_text(json.dumps({'token-1': 1, 'token-2': 2}))
+        monkeypatch.setattr(homework_module, 'TENANTS_FILE', str(path))
+        tokens = [tenant.token for tenant in homework_module.load_tenants()]
+        assert tokens == ['sometoken', 'token-1', 'token-2']
+
+    def test_poll_tenant_uses_tenant_token_and_chat(
+            self, homework_module, monkeypatch, random_timestamp
+    ):
+        calls = []
+
+        def mock_get(*args, **kwargs):
+            calls.append(kwargs['headers'])
+            return check_utils.MockResponseGET(
+                random_timestamp=random_timestamp, data={
+                    'homeworks': [
+                        {'homework_name': 'hw1', 'status': 'approved'}
+                    ],
+                    'current_date': random_timestamp
+                }
+            )
+
+        monkeypatch.setattr(requests, 'get', mock_get)
+        bot = check_utils.MockTelegramBot()
+        outbox = homework_module.SendQueue(bot)
+        tenant = homework_module.Tenant('other', 42)
+        homework_module.poll_tenant(outbox, tenant)
+        outbox.close()
+        assert calls == [{'Authorization': 'OAuth other'}]
+        assert bot.chat_id == 42
+        assert tenant.timestamp == random_timestamp
+
+
+class TestSharding:
+
+    def test_ring_moves_only_share_of_new_shard(self, homework_module):
+        keys = [homework_module.Tenant(str(i), i).key for i in range(1000)]
+        three = homework_module.HashRing(3)
+        four = homework_module.HashRing(4)
+        before = [three.shard(key) for key in keys]
+        after = [four.shard(key) for key in keys]
+        assert all(before.count(index) > 200 for index in range(3))
+        moved = [b for b, a in zip(before, after) if a != b]
+        assert all(after[i] == 3 for i in range(1000) if after[i] != before[i])
+        assert len(moved) < 400
+
+    def test_load_tenants_of_shard(self, homework_module, monkeypatch,
+                                   tmp_path):
+        path = tmp_path / 'tenants.json'
+        path.write_text(json.dumps({f'token-{i}': i for i in range(20)}))
+        monkeypatch.setattr(homework_module, 'TENANTS_FILE', str(path))
+        ring = homework_module.HashRing(2)
+        tokens = set()
+        for index in range(2):
+            monkeypatch.setattr(
+                homework_module, 'shard',
+                homework_module.Shard(index, ring, None)
+            )
+            tenants = homework_module.load_tenants()
+            assert tokens.isdisjoint(tenant.token for tenant in tenants)
+            tokens.update(tenant.token for tenant in tenants)
+        assert len(tokens) == 21
+
+    def test_shard_writes_own_event_log(self, homework_module, monkeypatch):
+        seen = []
+        monkeypatch.setattr(homework_module, 'EVENT_LOG', 'events.log')
+        monkeypatch.setattr(homework_module, 'SERVICE_PORT', None)
+        monkeypatch.setattr(homework_module, 'COMMANDS_MODE', None)
+        monkeypatch.setattr(homework_module, 'shard', None)
+        monkeypatch.setattr(homework_module.signal, 'signal', lambda *a: None)
+        monkeypatch.setattr(homework_module, 'setup_logging', lambda **k: None)
+        monkeypatch.setattr(
+            homework_module, 'main',
+            lambda: seen.append(homework_module.EVENT_LOG)
+        )
+        homework_module.run_shard(1, 2, None)
+        assert seen == ['events.log.1']
+
+    def test_shared_token_bucket(self, homework_module):
+        bucket = homework_module.SharedTokenBucket(2)
+        now = bucket.state[1]
+        assert bucket.wait(now) == 0
+        bucket.take()
+        bucket.take()
+        assert bucket.wait(now) == 0.5
+        bucket.pause(10)
+        assert bucket.wait(now + 1) == 9
+
+
+class TestAsyncMode:
+
+    def test_poll_tenant_async_without_session(
+            self, homework_module, monkeypatch, data_with_new_hw_status
+    ):
+        def polls():
+            histogram = homework_module.metrics.histograms.get(
+                'get_api_answer_seconds', [0]
+            )
+            return sum(histogram[:-1])
+
+        before = polls()
+        monkeypatch.setattr(
+            requests, 'get',
+            lambda *args, **kwargs: check_utils.MockResponseGET(
+                data=data_with_new_hw_status
+            )
+        )
+        bot = check_utils.MockTelegramBot()
+        outbox = homework_module.SendQueue(bot)
+        tenant = homework_module.Tenant('other', 42)
+        asyncio.run(homework_module.poll_tenant_async(
+            outbox, tenant, None, asyncio.Semaphore(1)
+        ))
+        outbox.close()
+        assert bot.chat_id == 42
+        assert bot.text.startswith(
+            'Изменился статус проверки работы "hw123.zip"'
+        )
+        assert polls() == before + 1
+
+
+    def test_aiohttp_answers(self, homework_module, monkeypatch):
+        pytest.importorskip('aiohttp')
+        import aiohttp
+        from benchmarks import standins
+
+        practicum = standins.start_practicum()
+        practicum.etag = '"v1"'
+        monkeypatch.setattr(homework_module, 'ENDPOINT', practicum.url)
+        tenant = homework_module.Tenant('token', 1)
+
+        async def poll():
+            homework_module.current_tenant.set(tenant)
+            async with aiohttp.ClientSession() as session:
+                answer = await homework_module.get_api_answer_async(
+                    0, session
+                )
+                homework_module.handle_answer(tenant, answer)
+                unchanged = await homework_module.get_api_answer_async(
+                    0, session
+                )
+                practicum.etag = None
+                practicum.status = 503
+                with pytest.raises(homework_module.APIStatusError) as error:
+                    await homework_module.get_api_answer_async(0, session)
+            return answer, unchanged, error.value.status
+
+        try:
+            answer, unchanged, status = asyncio.run(poll())
+        finally:
+            practicum.shutdown()
+        assert [homework['id'] for homework in answer['homeworks']] == [0]
+        assert tenant.etag == '"v1"'
+        assert unchanged is homework_module.UNCHANGED
+        assert status == 503
+
+    def test_main_async_polls_and_notifies(self, homework_module, monkeypatch):
+        pytest.importorskip('aiohttp')
+        from benchmarks import standins
+
+        practicum = standins.start_practicum()
+        monkeypatch.setattr(homework_module, 'ENDPOINT', practicum.url)
+        bot = check_utils.MockTelegramBot()
+        outbox = homework_module.SendQueue(bot)
+        tenant = homework_module.Tenant('token', 42)
+
+        async def run():
+            with pytest.raises(asyncio.TimeoutError):
+                await asyncio.wait_for(homework_module.main_async(
+                    [tenant], homework_module.MemoryStore(), outbox
+                ), 0.3)
+
+        try:
+            asyncio.run(run())
+        finally:
+            outbox.close()
+            practicum.shutdown()
+        assert practicum.requests == 1
+        assert bot.chat_id == 42
+        assert '"student__hw00000.zip"' in bot.text
+
+
+class TestSession:
+
+    def test_get_api_answer_uses_runtime_session(
+            self, homework_module, random_timestamp
+    ):
+        class MockSession:
+            def get(self, url, **kwargs):
+                self.url = url
+                return check_utils.MockResponseGET(
+                    random_timestamp=random_timestamp
+                )
+
+        session = MockSession()
+        token = homework_module.http_session.set(session)
+        try:
+            result = homework_module.get_api_answer(random_timestamp)
+        finally:
+            homework_module.http_session.reset(token)
+        assert session.url == homework_module.ENDPOINT
+        assert result['current_date'] == random_timestamp
+
+    def test_create_session_pool_size(self, homework_module):
+        session = homework_module.create_session(pool_size=32)
+        assert session.get_adapter(homework_module.ENDPOINT)._pool_maxsize == 32
+
+
+class TestShortCircuit:
+
+    def test_repeated_answer_is_not_decoded(
+            self, homework_module, monkeypatch
+    ):
+        bodies = iter([
+            b'{"homeworks": [], "current_date": 1}',
+            b'{"homeworks": [], "current_date": 2}',
+        ])
+
+        class MockResponse(check_utils.MockResponseGET):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.headers = {'ETag': '"v1"'}
+                self.content = next(bodies)
+
+            def json(self):
+                raise AssertionError('Answer is decoded from content')
+
+        sent_headers = []
+
+        def mock_get(*args, **kwargs):
+            sent_headers.append(kwargs['headers'])
+            return MockResponse()
+
+        monkeypatch.setattr(requests, 'get', mock_get)
+        monkeypatch.setattr(homework_module, 'metrics', homework_module.Metrics())
+        tenant = homework_module.Tenant('other', 42)
+        token = homework_module.current_tenant.set(tenant)
+        try:
+            first = homework_module.get_api_answer(0)
+            homework_module.handle_answer(tenant, first)
+            result = homework_module.get_api_answer(0)
+        finally:
+            homework_module.current_tenant.reset(token)
+        assert first == {'homeworks': [], 'current_date': 1}
+        assert result is homework_module.UNCHANGED
+        assert homework_module.metrics.get('short_circuited_total') == 1
+        assert sent_headers[1]['If-None-Match'] == '"v1"'
+        assert homework_module.handle_answer(tenant, result) == []
+
+    def test_failed_answer_is_handled_again(
+            self, homework_module, monkeypatch
+    ):
+        body = b'{"homeworks": {"id": 1}, "current_date": 1}'
+
+        class MockResponse(check_utils.MockResponseGET):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.headers = {}
+                self.content = body
+
+        monkeypatch.setattr(
+            requests, 'get', lambda *args, **kwargs: MockResponse()
+        )
+        tenant = homework_module.Tenant('failed', 42)
+        token = homework_module.current_tenant.set(tenant)
+        try:
+            for _ in range(2):
+                answer = homework_module.get_api_answer(0)
+                assert answer is not homework_module.UNCHANGED
+                with pytest.raises(homework_module.ResponseTypeError):
+                    homework_module.handle_answer(tenant, answer)
+        finally:
+            homework_module.current_tenant.reset(token)
+
+
+class TestDecoder:
+
+    BODY = (
+        b'{"homeworks": [{"homework_name": "hw", "status": "approved",'
+        b' "lesson_name": {"long": "text"}}],'
+        b' "current_date": 7, "comment": {"long": ["text"]}}'
+    )
+
+    def test_only_used_fields_are_decoded(self, homework_module):
+        assert homework_module.answer_decoder()(self.BODY) == {
+            'homeworks': [{'homework_name': 'hw', 'status': 'approved'}],
+            'current_date': 7,
+        }
+        assert homework_module.answer_decoder()(b'[1]') == [1]
+
+    def test_msgspec_builds_only_used_fields(self, homework_module):
+        msgspec = pytest.importorskip('msgspec')
+        decode = homework_module._msgspec_decoder(msgspec)
+        assert decode(self.BODY) == {
+            'homeworks': [{'homework_name': 'hw', 'status': 'approved'}],
+            'current_date': 7,
+        }
+        assert decode(b'{"homeworks": {"id": 1}, "extra": 1}') == {
+            'homeworks': {'id': 1}
+        }
+        assert decode(b'[1]') == [1]
+        with pytest.raises(ValueError):
+            decode(b'<html>')
+
+    def test_stdlib_fallback(self, homework_module, monkeypatch):
+        monkeypatch.setitem(sys.modules, 'msgspec', None)
+        monkeypatch.setitem(sys.modules, 'orjson', None)
+        homework_module.answer_decoder.cache_clear()
+        try:
+            decode = homework_module.answer_decoder()
+            assert decode(self.BODY) == {
+                'homeworks': [{'homework_name': 'hw', 'status': 'approved'}],
+                'current_date': 7,
+            }
+            with pytest.raises(ValueError):
+                decode(b'{')
+        finally:
+            homework_module.answer_decoder.cache_clear()
+
+
+class TestAdaptiveScheduler:
+
+    def test_interval_follows_tenant_state(self, homework_module):
+        scheduler = homework_module.Scheduler([], period=600)
+        tenant = homework_module.Tenant('token', 1)
+        assert scheduler.interval(tenant) == 600
+        tenant.reviewing = True
+        assert scheduler.interval(tenant) == homework_module.REVIEWING_PERIOD
+        tenant.errors = 1
+        assert scheduler.interval(tenant) == 600
+        tenant.errors = 3
+        assert 600 <= scheduler.interval(tenant) <= 2400
+
+    def test_budget_limits_polls(self, homework_module):
+        tenants = [homework_module.Tenant(str(index), index)
+                   for index in range(3)]
+        scheduler = homework_module.Scheduler(
+            tenants, period=600, now=0, budget=1
+        )
+        assert scheduler.pop_due(1000) == tenants[:1]
+        assert scheduler.delay(1000) == 1
+        assert scheduler.pop_due(1001) == tenants[1:2]
+
+
+class TestHomework:
+
+    def test_record_keeps_only_used_fields(self, homework_module):
+        raw = {
+            'id': 1, 'homework_name': 'hw', 'status': 'approved',
+            'date_updated': '2024-01-01', 'reviewer_comment': 'x' * 1000,
+            'lesson_name': 'lesson'
+        }
+        homework = homework_module.Homework.from_dict(raw)
+        assert homework == (1, 'hw', 'approved', '2024-01-01')
+        assert homework.status is homework_module.Status.APPROVED
+        assert not hasattr(homework, '__dict__')
+        assert sys.getsizeof(homework) < sys.getsizeof(raw)
+        assert homework_module.parse_status(homework) == (
+            homework_module.parse_status(raw)
+        )
+
+    def test_invalid_homework(self, homework_module):
+        for raw in ({'status': 'approved'}, {'homework_name': 'hw'},
+                    {'homework_name': 'hw', 'status': 'unknown'}):
+            with pytest.raises(KeyError):
+                homework_module.Homework.from_dict(raw)
+
+
+class TestCatalog:
+
+    def test_message_in_locale_of_tenant(self, homework_module):
+        raw = {'homework_name': 'hw', 'status': 'approved'}
+        assert homework_module.parse_status(raw) == (
+            'Изменился статус проверки работы "hw". '
+            + homework_module.HOMEWORK_VERDICTS['approved']
+        )
+        token = homework_module.current_tenant.set(
+            homework_module.Tenant('token', 1, locale='en')
+        )
+        try:
+            message = homework_module.parse_status(raw)
+        finally:
+            homework_module.current_tenant.reset(token)
+        assert message.startswith('Review status of "hw" changed.')
+
+    def test_custom_templates_and_cache(self, homework_module, tmp_path):
+        path = tmp_path / 'messages.json'
+        path.write_text(json.dumps({
+            'ru': {'message': '{{{name}}}: {verdict}'},
+            'de': {'message': '{name}: {verdict}',
+                   'verdicts': {'approved': 'Angenommen {x}'}},
+        }))
+        catalog = homework_module.MessageCatalog(homework_module.MESSAGES)
+        catalog.load(path)
+        assert catalog.format('approved', 'hw', 'de') == 'hw: Angenommen {x}'
+        assert catalog.format('rejected', 'hw', 'de') == (
+            'hw: ' + homework_module.HOMEWORK_VERDICTS['rejected']
+        )
+        assert catalog.format('reviewing', 'hw', 'fr') == (
+            '{hw}: ' + homework_module.HOMEWORK_VERDICTS['reviewing']
+        )
+        catalog.format('reviewing', 'hw', 'fr')
+        assert catalog.format.cache_info().hits == 1
+        with pytest.raises(ValueError):
+            catalog.update({'ru': {'message': '{student}'}})
+
+    def test_default_locale_is_checked(self, homework_module):
+        catalog = homework_module.MessageCatalog(
+            homework_module.MESSAGES, default='de'
+        )
+        with pytest.raises(ValueError):
+            catalog.check()
+        catalog.update({'de': {'message': '{name}: {verdict}', 'verdicts': {
+            status: status for status in homework_module.HOMEWORK_VERDICTS
+        }}})
+        catalog.check()
+        assert catalog.format('approved', 'hw', 'fr') == 'hw: approved'
+
+
+class TestIncremental:
+
+    def test_every_transition_is_reported_once(self, homework_module):
+        tenant = homework_module.Tenant('token', 1)
+        first = {
+            'homeworks': [
+                {'id': 2, 'homework_name': 'hw2', 'status': 'reviewing',
+                 'date_updated': '2021-04-02T00:00:00Z'},
+                {'id': 1, 'homework_name': 'hw1', 'status': 'approved',
+                 'date_updated': '2021-04-01T00:00:00Z'},
+            ],
+            'current_date': 10
+        }
+        homeworks = homework_module.handle_answer(tenant, first)
+        assert [homework.name for homework in homeworks] == ['hw2']
+        assert '"hw2"' in tenant.history[-1]
+        assert tenant.reviewing
+        second = {
+            'homeworks': [
+                {'id': 3, 'homework_name': 'hw3', 'status': 'reviewing',
+                 'date_updated': '2021-04-04T00:00:00Z'},
+                {'id': 2, 'homework_name': 'hw2', 'status': 'approved',
+                 'date_updated': '2021-04-03T00:00:00Z'},
+                {'id': 1, 'homework_name': 'hw1', 'status': 'approved',
+                 'date_updated': '2021-04-01T00:00:00Z'},
+            ],
+            'current_date': 20
+        }
+        homeworks = homework_module.handle_answer(tenant, second)
+        assert [homework.name for homework in homeworks] == ['hw2', 'hw3']
+        assert '"hw2"' in tenant.history[1]
+        assert '"hw3"' in tenant.history[2]
+        assert homework_module.handle_answer(tenant, second) == []
+        assert tenant.timestamp == 20
+
+    def test_empty_answer_is_not_error(self, homework_module):
+        tenant = homework_module.Tenant('token', 1)
+        answer = {'homeworks': [], 'current_date': 5}
+        assert homework_module.handle_answer(tenant, answer) == []
+        assert tenant.errors == 0
+        homeworks = homework_module.handle_answer(tenant, {
+            'homeworks': [
+                {'id': 1, 'homework_name': 'hw1', 'status': 'reviewing'},
+                {'id': 2, 'homework_name': 'hw2', 'status': 'reviewing'},
+            ],
+            'current_date': 6
+        })
+        assert [homework.name for homework in homeworks] == ['hw1', 'hw2']
+
+    def test_invalid_homework_is_skipped(self, homework_module, monkeypatch):
+        monkeypatch.setattr(homework_module, 'metrics', homework_module.Metrics())
+        tenant = homework_module.Tenant('token', 1, timestamp=5)
+        homeworks = homework_module.handle_answer(tenant, {
+            'homeworks': [
+                {'id': 1, 'homework_name': 'hw1', 'status': 'approved'},
+                {'id': 2, 'homework_name': 'hw2', 'status': 'unknown'},
+            ],
+            'current_date': 6
+        })
+        assert [homework.name for homework in homeworks] == ['hw1']
+        assert tenant.timestamp == 6
+        assert homework_module.metrics.get(
+            'errors_total', stage='parse', type='HomeworkError'
+        ) == 1
+
+
+class TestStateStore:
+
+    def test_sqlite_store_restores_state(self, homework_module, tmp_path):
+        path = str(tmp_path / 'state.db')
+        tenant = homework_module.Tenant('token', 1)
+        homework_module.handle_answer(tenant, {
+            'homeworks': [{'id': 7, 'homework_name': 'hw7',
+                           'status': 'reviewing'}],
+            'current_date': 1234
+        })
+        tenant.failures.add(homework_module.APIStatusError(503), now=100)
+        store = homework_module.SQLiteStore(path)
+        store.save([tenant])
+        store.close()
+
+        store = homework_module.SQLiteStore(path)
+        restored, = store.restore([homework_module.Tenant('token', 1)])
+        store.close()
+        assert restored.timestamp == 1234
+        assert restored.statuses == {
+            7: homework_module.Homework(7, 'hw7', 'reviewing', None)
+        }
+        assert restored.statuses[7].status is homework_module.Status.REVIEWING
+        assert restored.reviewing
+        assert not restored.failures.add(
+            homework_module.APIStatusError(503), now=200
+        )
+        assert restored.failures.kinds == {
+            ('APIStatusError', 'practicum'): [100, 1]
+        }
+
+    def test_memory_store_without_state_db(self, homework_module, caplog):
+        with caplog.at_level(logging.WARNING):
+            assert type(homework_module.open_store()) is (
+                homework_module.MemoryStore
+            )
+        assert 'Without STATE_DB' in caplog.text
+
+
+class TestEventLog:
+
+    def answer(self, status, date):
+        return {'homeworks': [{
+            'id': 7, 'homework_name': 'hw7', 'status': status,
+            'reviewer_comment': 'Замечания' if status == 'rejected' else '',
+            'date_updated': date,
+        }], 'current_date': 1}
+
+    def test_transitions_are_replayed(self, homework_module, tmp_path):
+        path = str(tmp_path / 'events.log')
+        log = homework_module.EventLog(path)
+        token = homework_module.event_log.set(log)
+        tenant = homework_module.Tenant('token', 1)
+        try:
+            for status, date in (('reviewing', '2024-01-01T00:00:00Z'),
+                                 ('rejected', '2024-01-02T00:00:00Z')):
+                homework_module.handle_answer(tenant, self.answer(status, date))
+        finally:
+            homework_module.event_log.reset(token)
+        log.close()
+        with open(path, 'ab') as file:
+            file.write(b'\x40\x00')
+
+        log = homework_module.EventLog(path)
+        events = list(log.replay())
+        assert [event.status for event in events] == ['reviewing', 'rejected']
+        assert events[1].comment == 'Замечания'
+        assert events[1].date_updated - events[0].date_updated == 86400
+        restored, = log.restore([homework_module.Tenant('token', 1)])
+        log.close()
+        assert restored.statuses[7].status is homework_module.Status.REJECTED
+
+    def test_compaction_drops_repeated_transitions(
+            self, homework_module, tmp_path
+    ):
+        path = str(tmp_path / 'events.log')
+        log = homework_module.EventLog(path, compact=0)
+        for _ in range(3):
+            tenant = homework_module.Tenant('token', 1)
+            log.append(tenant, tenant.changes(
+                self.answer('approved', '2024-01-03T00:00:00Z')['homeworks']
+            ))
+        assert len(list(log.replay())) == 1
+        log.close()
+
+
+class TestHistoryIndex:
+
+    def poll(self, homework_module, log, tenant, *homeworks):
+        log.append(tenant, tenant.changes([
+            {'id': name, 'homework_name': name, 'status': status,
+             'date_updated': f'2024-01-{day:02}T00:00:00Z'}
+            for name, status, day in homeworks
+        ]))
+        tenant.commit([
+            homework_module.Homework(name, name, status, None)
+            for name, status, _ in homeworks
+        ])
+
+    def test_lookups_by_tenant_and_homework(self, homework_module, tmp_path):
+        path = str(tmp_path / 'events.log')
+        log = homework_module.EventLog(path)
+        first = homework_module.Tenant('first', 1)
+        second = homework_module.Tenant('second', 2)
+        self.poll(homework_module, log, first,
+                  ('hw1', 'reviewing', 1), ('hw2', 'reviewing', 2))
+        self.poll(homework_module, log, second, ('hw1', 'reviewing', 1))
+        self.poll(homework_module, log, first,
+                  ('hw1', 'rejected', 3), ('hw2', 'approved', 3))
+        self.poll(homework_module, log, first, ('hw1', 'reviewing', 4))
+        self.poll(homework_module, log, first, ('hw1', 'approved', 5))
+
+        history = log.history(first.key, 'hw1')
+        assert [event.status for event in history] == [
+            'approved', 'reviewing', 'rejected', 'reviewing'
+        ]
+        assert len(log.history(first.key)) == 6
+        assert [event.name for event in log.history(first.key, limit=2)] == [
+            'hw1', 'hw1'
+        ]
+        assert sorted(log.reviewing_times(first.key)) == [
+            86400, 86400, 2 * 86400
+        ]
+        assert log.reviewing_times(second.key) == []
+        log.close()
+
+        os.remove(f'{path}.idx')
+        log = homework_module.EventLog(path)
+        assert len(log.history(first.key)) == 6
+        assert homework_module.answer_command(
+            [first], 'history', log=log
+        ).endswith('Среднее время проверки: 32.0 ч.')
+        log.close()
+
+    def test_append_after_torn_tail(
+            self, homework_module, tmp_path, monkeypatch
+    ):
+        path = str(tmp_path / 'events.log')
+        tenant = homework_module.Tenant('first', 1)
+        log = homework_module.EventLog(path)
+        self.poll(homework_module, log, tenant, ('hw1', 'reviewing', 1))
+        log.close()
+        with open(path, 'ab') as file:
+            file.write(b'\x40\x00\x00\x00torn')
+
+        log = homework_module.EventLog(path)
+        self.poll(homework_module, log, tenant, ('hw1', 'approved', 2))
+        monkeypatch.setattr(log, '_reindex', lambda: pytest.fail('reindex'))
+        assert [event.status for event in log.history(tenant.key)] == [
+            'approved', 'reviewing'
+        ]
+        assert log.index.covered == os.path.getsize(path)
+        log.close()
+
+    def test_startup_reads_only_uncovered_tail(
+            self, homework_module, tmp_path, monkeypatch
+    ):
+        path = str(tmp_path / 'events.log')
+        tenant = homework_module.Tenant('first', 1)
+        log = homework_module.EventLog(path)
+        self.poll(homework_module, log, tenant,
+                  ('hw1', 'reviewing', 1), ('hw2', 'reviewing', 1))
+        self.poll(homework_module, log, tenant, ('hw1', 'approved', 2))
+        covered = log.index.covered
+        log.close()
+        with open(path, 'ab') as file:
+            file.write(b'\x40\x00\x00\x00torn')
+
+        starts = []
+        records = homework_module.EventLog._records
+
+        def spy(self, start=0):
+            starts.append(start)
+            return records(self, start)
+
+        monkeypatch.setattr(homework_module.EventLog, '_records', spy)
+        monkeypatch.setattr(
+            homework_module.EventLog, 'state',
+            lambda self: pytest.fail('state is replayed')
+        )
+        log = homework_module.EventLog(path)
+        restored, = log.restore([homework_module.Tenant('first', 1)])
+        assert starts == [covered]
+        assert os.path.getsize(path) == covered
+        assert {key: homework.status for key, homework in
+                restored.statuses.items()} == {
+            'hw1': homework_module.Status.APPROVED,
+            'hw2': homework_module.Status.REVIEWING,
+        }
+        log.close()
+
+    def test_records_of_other_tenant_are_skipped(
+            self, homework_module, tmp_path
+    ):
+        path, other = str(tmp_path / 'events.log'), str(tmp_path / 'other')
+        first = homework_module.Tenant('first', 1)
+        second = homework_module.Tenant('second', 2)
+        for log_path, tenant in ((path, first), (other, second)):
+            log = homework_module.EventLog(log_path)
+            self.poll(homework_module, log, tenant, ('hw1', 'reviewing', 1))
+            log.close()
+        os.replace(other, path)
+
+        log = homework_module.EventLog(path)
+        assert log.history(first.key) == []
+        assert [event.tenant for event in log.history(second.key)] == [
+            second.key
+        ]
+        log.close()
+
+
+class TestSendQueue:
+
+    def test_pending_messages_of_chat_are_coalesced(self, homework_module):
+        bot = check_utils.MockTelegramBot()
+        outbox = homework_module.SendQueue(bot, rate=30, chat_rate=1)
+        with outbox.condition:
+            for text in ('first', 'second'):
+                outbox.put(7, text)
+        outbox.close()
+        assert (bot.chat_id, bot.text) == (7, 'first\n\nsecond')
+
+    def test_too_many_requests_is_retried(self, homework_module):
+        class FloodBot(check_utils.MockTelegramBot):
+            calls = 0
+
+            def send_message(self, chat_id=None, text=None, **kwargs):
+                FloodBot.calls += 1
+                if FloodBot.calls == 1:
+                    raise telebot.apihelper.ApiTelegramException(
+                        'sendMessage', None, {
+                            'error_code': 429,
+                            'description': 'Too Many Requests',
+                            'parameters': {'retry_after': 0.01}
+                        }
+                    )
+                super().send_message(chat_id, text)
+
+        bot = FloodBot()
+        outbox = homework_module.SendQueue(bot, rate=30, chat_rate=100)
+        outbox.put(7, 'text')
+        outbox.close()
+        assert (FloodBot.calls, bot.text) == (2, 'text')
+
+
+class TestFanOut:
+
+    def test_change_is_formatted_once_per_locale(self, homework_module,
+                                                 monkeypatch, tmp_path):
+        path = tmp_path / 'tenants.json'
+        path.write_text(json.dumps({'token': [
+            1, {'chat_id': 2, 'locale': 'en'}, {'chat_id': 3, 'locale': 'en'}
+        ]}))
+        monkeypatch.setattr(homework_module, 'TENANTS_FILE', str(path))
+        monkeypatch.setattr(homework_module, 'PRACTICUM_TOKEN', None)
+        monkeypatch.setattr(
+            homework_module, 'catalog',
+            homework_module.MessageCatalog(homework_module.MESSAGES)
+        )
+        tenant, = homework_module.load_tenants()
+        homework_module.answer_command([tenant], 'pause', 3)
+        homeworks = homework_module.handle_answer(tenant, {
+            'homeworks': [{'homework_name': 'hw', 'status': 'approved'}],
+            'current_date': 1
+        })
+        outbox = homework_module.SendQueue(check_utils.MockTelegramBot())
+        with outbox.condition:
+            homework_module.notify(outbox, tenant, homeworks)
+            sent = {chat: list(texts) for chat, texts in outbox.pending.items()}
+        outbox.close()
+        assert list(sent) == [1, 2]
+        assert sent[1] == [tenant.history[-1]]
+        assert sent[2][0].startswith('Review status of "hw"')
+        assert homework_module.catalog.format.cache_info().misses == 2
+
+    def test_chats_are_sent_to_concurrently_in_order(self, homework_module):
+        class SlowBot:
+            def __init__(self):
+                self.sent = []
+
+            def send_message(self, chat_id=None, text=None, **kwargs):
+                time.sleep(0.05)
+                self.sent.append((chat_id, text))
+
+        bot = SlowBot()
+        outbox = homework_module.SendQueue(
+            bot, rate=100, chat_rate=100, workers=4
+        )
+        started = time.monotonic()
+        with outbox.condition:
+            for chat in range(4):
+                outbox.put(chat, 'first')
+        for chat in range(4):
+            outbox.put(chat, 'second')
+        outbox.close()
+        assert time.monotonic() - started < 0.35
+        for chat in range(4):
+            texts = [text for chat_id, text in bot.sent if chat_id == chat]
+            assert '\n\n'.join(texts) == 'first\n\nsecond'
+
+
+class TestCircuitBreaker:
+
+    def test_transitions(self, homework_module, monkeypatch):
+        monkeypatch.setattr(homework_module, 'metrics', homework_module.Metrics())
+        breaker = homework_module.CircuitBreaker(
+            'test', failures=2, cooldown=10
+        )
+        breaker.failure(now=0)
+        assert breaker.wait(0) == 0
+        breaker.failure(now=0)
+        assert (breaker.state, breaker.wait(5)) == ('open', 5)
+        with pytest.raises(homework_module.CircuitOpenError):
+            breaker.check(5)
+        assert breaker.wait(10) == 0
+        assert (breaker.state, breaker.wait(11)) == ('half_open', 9)
+        breaker.failure(now=12)
+        assert (breaker.state, breaker.wait(21)) == ('open', 1)
+        assert breaker.wait(22) == 0
+        breaker.success()
+        assert (breaker.state, breaker.wait(22)) == ('closed', 0)
+        assert homework_module.metrics.get(
+            'breaker_transitions_total', breaker='test', state='open'
+        ) == 2
+
+    def test_practicum_fails_fast(self, homework_module, monkeypatch):
+        calls = []
+
+        def mock_get(*args, **kwargs):
+            calls.append(kwargs)
+            raise requests.ConnectionError('down')
+
+        monkeypatch.setattr(requests, 'get', mock_get)
+        monkeypatch.setattr(homework_module, 'RETRIES', 0)
+        breaker = homework_module.CircuitBreaker(
+            'practicum', failures=2, cooldown=60
+        )
+        token = homework_module.practicum_breaker.set(breaker)
+        try:
+            for _ in range(4):
+                with pytest.raises(Exception):
+                    homework_module.get_api_answer(0)
+        finally:
+            homework_module.practicum_breaker.reset(token)
+        assert len(calls) == 2
+        assert breaker.state == 'open'
+
+    def test_telegram_outage_keeps_messages(self, homework_module):
+        class DownBot(check_utils.MockTelegramBot):
+            calls = 0
+
+            def send_message(self, chat_id=None, text=None, **kwargs):
+                DownBot.calls += 1
+                if DownBot.calls <= 2:
+                    raise requests.ConnectionError('down')
+                super().send_message(chat_id, text)
+
+        bot = DownBot()
+        breaker = homework_module.CircuitBreaker(
+            'telegram', failures=2, cooldown=0.1
+        )
+        outbox = homework_module.SendQueue(
+            bot, rate=100, chat_rate=100, breaker=breaker
+        )
+        outbox.put(7, 'text')
+        outbox.close()
+        assert (DownBot.calls, bot.text) == (3, 'text')
+        assert breaker.state == 'closed'
+
+
+class TestErrors:
+
+    def test_errors_are_typed(self, homework_module, monkeypatch):
+        monkeypatch.setattr(
+            requests, 'get',
+            lambda *args, **kwargs: check_utils.MockResponseGET(
+                *args, data={}, http_status=503, **kwargs
+            )
+        )
+        with pytest.raises(homework_module.APIStatusError) as error:
+            homework_module.get_api_answer(0)
+        assert error.value.status == 503
+        assert error.value.upstream == 'practicum'
+        with pytest.raises(homework_module.ResponseTypeError):
+            homework_module.check_response({'homeworks': {}})
+        with pytest.raises(homework_module.HomeworkError):
+            homework_module.parse_status({'homework_name': 'hw'})
+        assert homework_module.error_kind(
+            homework_module.CircuitOpenError('telegram')
+        ) == ('CircuitOpenError', 'telegram')
+
+    def test_broken_body_is_failure_of_practicum(
+            self, homework_module, monkeypatch
+    ):
+        class MockResponse(check_utils.MockResponseGET):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.content = b'<html>Maintenance</html>'
+
+        monkeypatch.setattr(
+            requests, 'get', lambda *args, **kwargs: MockResponse()
+        )
+        breaker = homework_module.CircuitBreaker(
+            'practicum', failures=2, cooldown=60
+        )
+        token = homework_module.practicum_breaker.set(breaker)
+        try:
+            for _ in range(2):
+                with pytest.raises(homework_module.ResponseDecodeError):
+                    homework_module.get_api_answer(0)
+        finally:
+            homework_module.practicum_breaker.reset(token)
+        assert breaker.state == 'open'
+
+    def test_repeats_go_to_digest(self, homework_module):
+        tenant = homework_module.Tenant('token', 1)
+        error = homework_module.APIStatusError(503)
+        assert homework_module.handle_error(tenant, error) == [
+            'Сбой в работе программы: Ошибка в статусе ответа: 503'
+        ]
+        assert homework_module.handle_error(tenant, error) == []
+        window = homework_module.ErrorWindow(window=3600)
+        assert window.add(error, now=0)
+        for now in range(1, 13):
+            assert not window.add(error, now=now)
+        assert window.add(KeyError('other'), now=13)
+        assert window.flush(now=3599) == []
+        assert window.flush(now=3600) == [
+            'Сбой APIStatusError (practicum) повторился 12 раз за 60 мин.'
+        ]
+        assert window.flush(now=7200) == []
+        assert window.kinds == {}
+
+
+class TestResilience:
+
+    def test_connection_errors_are_retried_within_budget(
+            self, homework_module, monkeypatch, random_timestamp
+    ):
+        calls = []
+
+        def mock_get(*args, **kwargs):
+            calls.append(kwargs['timeout'])
+            if len(calls) < 3:
+                raise requests.Timeout('slow')
+            return check_utils.MockResponseGET(
+                random_timestamp=random_timestamp
+            )
+
+        monkeypatch.setattr(requests, 'get', mock_get)
+        monkeypatch.setattr(homework_module, 'RETRY_BACKOFF', 0.01)
+        monkeypatch.setattr(
+            homework_module, 'retry_budget', homework_module.RetryBudget()
+        )
+        answer = homework_module.get_api_answer(0)
+        assert answer['current_date'] == random_timestamp
+        assert calls == [(
+            homework_module.CONNECT_TIMEOUT, homework_module.READ_TIMEOUT
+        )] * 3
+
+        calls.clear()
+        monkeypatch.setattr(
+            homework_module, 'retry_budget',
+            homework_module.RetryBudget(ratio=0, reserve=1)
+        )
+        with pytest.raises(Exception):
+            homework_module.get_api_answer(0)
+        assert len(calls) == 2
+
+        calls.clear()
+        monkeypatch.setattr(homework_module, 'RETRIES', 5)
+        budget = homework_module.RetryBudget(ratio=0.5, reserve=10)
+        budget.tokens = 1
+        monkeypatch.setattr(homework_module, 'retry_budget', budget)
+
+        def timeout_get(*args, **kwargs):
+            calls.append(kwargs['timeout'])
+            raise requests.Timeout('slow')
+
+        monkeypatch.setattr(requests, 'get', timeout_get)
+        with pytest.raises(Exception):
+            homework_module.get_api_answer(0)
+        assert len(calls) == 2
+
+    def test_slow_request_is_hedged(self, homework_module, monkeypatch):
+        delays = iter([0.5, 0.01])
+
+        class Http:
+            def get(self, url, **kwargs):
+                time.sleep(next(delays))
+                return url
+
+        window = homework_module.LatencyWindow()
+        for _ in range(homework_module.HEDGE_SAMPLES):
+            window.add(0.05)
+        monkeypatch.setattr(homework_module, 'api_latency', window)
+        started = time.monotonic()
+        assert homework_module._hedged_get(Http(), {}) == (
+            homework_module.ENDPOINT
+        )
+        assert time.monotonic() - started < 0.3
+
+
+class TestCommands:
+
+    def test_commands_are_answered_from_state(self, homework_module):
+        tenant = homework_module.Tenant('token', 1)
+        homework_module.handle_answer(tenant, {
+            'homeworks': [{'id': 7, 'homework_name': 'hw7',
+                           'status': 'reviewing'}],
+            'current_date': 1
+        })
+        status = homework_module.answer_command([tenant], 'status')
+        assert status == '"hw7": Работа взята на проверку ревьюером.'
+        history = homework_module.answer_command([tenant], 'history')
+        assert history == tenant.history[-1]
+        homework_module.answer_command([tenant], 'pause')
+        assert tenant.paused
+        homework_module.notify(None, tenant, ['not sent'])
+        homework_module.answer_command([tenant], 'pause')
+        assert not tenant.paused
+
+    def test_unknown_chat(self, homework_module):
+        assert homework_module.answer_command([], 'status').startswith(
+            'Чат не подписан'
+        )
+
+
+class TestStandIns:
+
+    def test_pipeline_against_stand_ins(self, homework_module, monkeypatch):
+        from benchmarks import standins
+
+        monkeypatch.setattr(telebot.apihelper, 'API_URL', None)
+        practicum = standins.start_practicum(homeworks=3)
+        telegram = standins.start_telegram()
+        monkeypatch.setattr(homework_module, 'ENDPOINT', practicum.url)
+        try:
+            homeworks = homework_module.check_response(
+                homework_module.get_api_answer(0)
+            )
+            message = homework_module.parse_status(homeworks[0])
+            homework_module.send_message(
+                telebot.TeleBot('1:test', threaded=False), message
+            )
+        finally:
+            practicum.shutdown()
+            telegram.shutdown()
+        assert len(homeworks) == 3
+        assert (practicum.requests, telegram.requests) == (1, 1)
+
+
+class TestWebhook:
+
+    def test_command_by_webhook_against_fake_telegram(
+            self, homework_module, monkeypatch
+    ):
+        from benchmarks import standins
+
+        monkeypatch.setattr(telebot.apihelper, 'API_URL', None)
+        monkeypatch.setattr(homework_module, 'COMMANDS_MODE', 'webhook')
+        monkeypatch.setattr(
+            homework_module, 'WEBHOOK_URL', 'https://bot.example/hook'
+        )
+        monkeypatch.setattr(homework_module, 'WEBHOOK_SECRET', 'secret')
+        monkeypatch.setattr(homework_module, 'SERVICE_PORT', 0)
+        telegram = standins.start_telegram()
+        bot = telebot.TeleBot('1:test')
+        outbox = homework_module.SendQueue(bot)
+        routes = {}
+        homework_module.start_commands(
+            bot, [homework_module.Tenant('token', 42)], outbox, routes
+        )
+        service = homework_module.start_service(routes)
+        update = json.dumps({'update_id': 1, 'message': {
+            'message_id': 1, 'date': 0, 'text': '/status',
+            'chat': {'id': 42, 'type': 'private'},
+        }}).encode()
+        try:
+            for body, secret, status in (
+                (update, 'forged', 403), (update, 'secret', 200),
+                (b'{', 'secret', 400),
+            ):
+                request = urllib.request.Request(
+                    f'http://127.0.0.1:{service.server_port}/hook',
+                    data=body, method='POST',
+                    headers={'X-Telegram-Bot-Api-Secret-Token': secret}
+                )
+                try:
+                    with urllib.request.urlopen(request) as answer:
+                        assert answer.status == status
+                except urllib.error.HTTPError as error:
+                    assert error.code == status
+            for length, status in (('x', 400), (str(1 << 30), 413)):
+                connection = http.client.HTTPConnection(
+                    '127.0.0.1', service.server_port
+                )
+                connection.putrequest('POST', '/hook')
+                connection.putheader('Content-Length', length)
+                connection.endheaders()
+                assert connection.getresponse().status == status
+                connection.close()
+            deadline = time.monotonic() + 1
+            while len(telegram.calls) < 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            outbox.close()
+            service.shutdown()
+            telegram.shutdown()
+        (set_webhook, webhook), (send, message) = telegram.calls
+        assert (set_webhook, webhook['url']) == (
+            'setWebhook', 'https://bot.example/hook'
+        )
+        assert (send, message['chat_id']) == ('sendMessage', '42')
+        assert message['text'].startswith('Статусов')
+
+    def test_supervisor_passes_update_to_owning_shard(
+            self, homework_module, monkeypatch
+    ):
+        class Worker:
+            def is_alive(self):
+                return True
+
+        ring = homework_module.HashRing(2)
+        tokens = {}
+        for number in range(100):
+            token = f'token-{number}'
+            tokens.setdefault(
+                ring.shard(homework_module.Tenant(token, 0).key), token
+            )
+        tenants = [
+            homework_module.Tenant(tokens[index], 100 + index)
+            for index in (0, 1)
+        ]
+        monkeypatch.setattr(
+            homework_module, 'WEBHOOK_URL', 'https://bot.example/hook'
+        )
+        monkeypatch.setattr(homework_module, 'WEBHOOK_SECRET', 'secret')
+        received = [[], []]
+
+        def shard_route(index):
+            def route(headers, read):
+                assert headers['X-Telegram-Bot-Api-Secret-Token'] == 'secret'
+                received[index].append(json.loads(read()))
+                return 200, 'application/json', '{}'
+            return route
+
+        shards = [
+            homework_module.start_service(
+                {('POST', '/hook'): shard_route(index)}, port=0
+            )
+            for index in (0, 1)
+        ]
+        monkeypatch.setattr(
+            homework_module, '_shard_url',
+            lambda index, path: (
+                f'http://127.0.0.1:{shards[index].server_port}{path}'
+            )
+        )
+        route = homework_module.forward_route([Worker(), Worker()], tenants)
+
+        def update(chat_id):
+            return json.dumps({'update_id': chat_id, 'message': {
+                'chat': {'id': chat_id}, 'text': '/status'
+            }}).encode()
+
+        headers = {'X-Telegram-Bot-Api-Secret-Token': 'secret'}
+        try:
+            assert route({}, lambda: pytest.fail('body is read'))[0] == 403
+            for chat_id in (101, 100, 7):
+                assert route(headers, lambda: update(chat_id))[0] == 200
+        finally:
+            for service in shards:
+                service.shutdown()
+        assert [
+            [update['update_id'] for update in updates]
+            for updates in received
+        ] == [[100, 7], [101]]
+
+    def test_webhook_is_not_set_without_secret(
+            self, homework_module, monkeypatch
+    ):
+        monkeypatch.setattr(
+            homework_module, 'WEBHOOK_URL', 'https://bot.example/hook'
+        )
+        monkeypatch.setattr(homework_module, 'WEBHOOK_SECRET', None)
+        monkeypatch.setattr(homework_module, 'SERVICE_PORT', 0)
+        routes = {}
+        homework_module._start_webhook(None, routes)
+        assert routes == {}
+        route = homework_module.webhook_route(None, secret=None, workers=1)
+        assert route({}, lambda: pytest.fail('body is read'))[0] == 403
+
+
+class TestMetrics:
+
+    def test_render_prometheus_text(self, homework_module):
+        metrics = homework_module.Metrics()
+        metrics.inc('errors_total', stage='poll', type='KeyError')
+        metrics.observe('parse_status_seconds', 0.002)
+        metrics.gauge('send_queue_depth', lambda: 3)
+        text = metrics.render()
+        assert (
+            'homework_bot_errors_total{stage="poll",type="KeyError"} 1'
+        ) in text
+        assert 'homework_bot_parse_status_seconds_bucket{le="0.005"} 1' in text
+        assert 'homework_bot_parse_status_seconds_count 1' in text
+        assert 'homework_bot_send_queue_depth 3' in text
+
+    def test_metrics_are_served(self, homework_module):
+        outbox = homework_module.SendQueue(check_utils.MockTelegramBot())
+        server = homework_module.start_service(
+            homework_module.service_routes(outbox), port=0
+        )
+        try:
+            with urllib.request.urlopen(
+                f'http://127.0.0.1:{server.server_port}/metrics'
+            ) as response:
+                body = response.read().decode()
+        finally:
+            server.shutdown()
+            outbox.close()
+        assert 'homework_bot_send_queue_depth 0' in body
+
+    def test_health_fails_when_cycle_stalls(self, homework_module):
+        outbox = homework_module.SendQueue(check_utils.MockTelegramBot())
+        alive = homework_module.Liveness()
+        token = homework_module.liveness.set(alive)
+        server = homework_module.start_service(
+            homework_module.service_routes(outbox), port=0
+        )
+        url = f'http://127.0.0.1:{server.server_port}'
+        try:
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(f'{url}/ready')
+            assert error.value.code == 503
+            alive.poll()
+            with urllib.request.urlopen(f'{url}/health') as response:
+                report = json.loads(response.read())
+            assert report['status'] == 'ok'
+            assert report['since_send'] is None
+            assert report['send_queue'] == 0
+            assert report['practicum_breaker'] == 'closed'
+            with urllib.request.urlopen(f'{url}/ready') as response:
+                assert response.status == 200
+            alive.beat(delay=10)
+            alive.beaten -= homework_module.STALL_PERIODS * (
+                homework_module.RETRY_PERIOD
+            ) + 1
+            with pytest.raises(urllib.error.HTTPError) as error:
+                urllib.request.urlopen(f'{url}/health')
+            assert error.value.code == 503
+            assert json.loads(error.value.read())['status'] == 'stalled'
+        finally:
+            homework_module.liveness.reset(token)
+            server.shutdown()
+            outbox.close()
+
+
+    def test_supervisor_aggregates_health_of_shards(
+            self, homework_module, monkeypatch
+    ):
+        class Worker:
+            def __init__(self, alive):
+                self.alive = alive
+
+            def is_alive(self):
+                return self.alive
+
+        outbox = homework_module.SendQueue(check_utils.MockTelegramBot())
+        token = homework_module.liveness.set(homework_module.Liveness())
+        shard = homework_module.start_service(
+            homework_module.service_routes(outbox), port=0
+        )
+        homework_module.liveness.reset(token)
+        monkeypatch.setattr(
+            homework_module, 'SERVICE_PORT', str(shard.server_port - 1)
+        )
+        workers = [Worker(True)]
+        health = homework_module.supervisor_routes(workers)['/health']
+        try:
+            assert health()[0] == 200
+            workers.append(Worker(False))
+            status, _, body = health()
+        finally:
+            shard.shutdown()
+            outbox.close()
+        assert status == 503
+        assert json.loads(body)['shards'] == ['ok', 'dead']
+
+
+class TestLogging:
+
+    def test_queue_handler_does_not_format_traceback(self, homework_module):
+        log_queue = queue.SimpleQueue()
+        handler = homework_module.LogQueueHandler(log_queue)
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            record = logging.getLogger('test').makeRecord(
+                'test', logging.ERROR, __file__, 1, 'failed %s', ('poll',),
+                sys.exc_info()
+            )
+        handler.handle(record)
+        queued = log_queue.get_nowait()
+        assert queued.msg == 'failed poll' and queued.exc_text is None
+        data = json.loads(homework_module.JsonFormatter().format(queued))
+        assert data['message'] == 'failed poll'
+        assert 'ValueError: boom' in data['exc_info']
+
+
+class TestImport:
+
+    def test_import_has_no_side_effects(self, tmp_path):
+        code = (
+            'import sys, logging, homework; '
+            'print(sorted(name for name in ("requests", "telebot", '
+            '"aiohttp", "asyncio") if name in sys.modules), '
+            'logging.getLogger().handlers)'
+        )
+        output = subprocess.run(
+            [sys.executable, '-c', code], cwd=tmp_path, text=True,
+            capture_output=True, check=True,
+            env={**os.environ, 'PYTHONPATH': os.getcwd()}
+        ).stdout
+        assert output.strip() == '[] []'
+        assert list(tmp_path.iterdir()) == []